@@ -1,19 +1,31 @@
 import threading
 import socket
 import os
-import hashlib
 import subprocess
+import time
+import select
+import ssl
+import tls_transport
+import local_transport
+import control
+import udp_channel
+import hashing
+from collections import deque
+from console import console
+from receive_limits import ReceiveBudget, LineTooLong, STALL_TIMEOUT
 MAX_MSG_LEN = 100
 
+# used by receivers started without a ConnectionManager
+_default_budget = ReceiveBudget()
+
 def play_notification_sound():
-    """Play a notification sound"""
+    """Play a notification sound without waiting for it to finish"""
     try:
         # Use the system "Glass" sound (built-in)
-        subprocess.run(['afplay', '/System/Library/Sounds/Funk.aiff'], 
-                        check=False, timeout=1, 
-                        stdout=subprocess.DEVNULL, 
-                        stderr=subprocess.DEVNULL)
-    except (subprocess.TimeoutExpired, FileNotFoundError, OSError):
+        subprocess.Popen(['afplay', '/System/Library/Sounds/Funk.aiff'],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+    except (FileNotFoundError, OSError):
         # Fallback to terminal bell
         print('\a', end='', flush=True)
     
@@ -21,6 +33,9 @@ def play_notification_sound():
         # Silent fallback - don't break the program if sound fails
         pass
 
+# the console writer plays the sound for received messages and files
+console.notify = play_notification_sound
+
 def send_command(full_line: str, conn_manager):
     """
     Send a message to a specific connection
@@ -51,25 +66,116 @@ def send_command(full_line: str, conn_manager):
         print(f'Error: no connection with id {cid}.')
         return
 
-    sock = conn_info['sock']
+    # Over UDP when the peer offers it, so the message skips any file
+    # transfer queued on the stream
+    if conn_manager.udp is not None and udp_channel.usable(conn_info):
+        if conn_manager.udp.send_message(cid, conn_info, msg):
+            print(f'Message sent to {cid}')
+            return
+
+    line = msg + '\n'
+    seq = None
+    if 'ack' in conn_info['peer_caps']:
+        # peer confirms delivery; unacknowledged messages are reported. The
+        # timeout starts once the message is actually on the wire.
+        seq = conn_manager.acks.next_seq()
+        conn_manager.acks.register(cid, 'm' + seq, f'Message {seq}', None)
+        line = f'__MSG__ {seq} {line}'
+
+    def on_sent(error):
+        if error is None:
+            console.emit(f'Message sent to {cid}')
+            if seq is not None:
+                conn_manager.acks.rearm(cid, 'm' + seq, control.MESSAGE_ACK_TIMEOUT)
+        else:
+            console.error(f'Error: failed to send to {cid}: {error}')
+            # Remove the connection if it's broken
+            conn_manager.remove_connection(cid)
+
+    # Never blocks behind a file transfer on this connection: the message
+    # is queued and goes out (and is reported sent) right after it
     try:
-        sock.sendall((msg + '\n').encode('utf-8'))
-        print(f'Message sent to {cid}')
+        conn_info['writer'].send_nowait(line.encode('utf-8'), on_sent)
+    except OSError:
+        pass  # reported by on_sent
+
+
+def _wait_readable(sock, poller, timeout):
+    """Wait until sock has data, so idle connections hold no receive budget"""
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        return True
+    if poller is None:
+        return True
+    return bool(poller.poll(timeout * 1000))
+
+def _finish_file(file_name, file_hasher, expected_checksum, peer_ip, peer_port):
+    """
+    Verify a completely received file, deleting it if the checksum is wrong.
+    Returns True if the file was verified.
+    """
+    peer = f'{peer_ip}:{peer_port}'
+    expected_checksum = hashing.parse_field(expected_checksum)[1]
+    # Calculate checksum of received data
+    if file_hasher:
+        received_checksum = file_hasher.hexdigest()
+    else:
+        # Should not happen, but handle gracefully
+        console.error(f'ERROR: Checksum calculator not initialized for file "{file_name}"', peer)
+        received_checksum = None
+
+    # Verify checksum matches
+    if received_checksum and received_checksum == expected_checksum:
+        console.emit(f'File "{file_name}" received successfully from {peer_ip}:{peer_port}\n'
+                     f'Checksum verified: {received_checksum[:16]}...',
+                     peer=peer, alert=True)
+        return True
+    else:
+        # Checksum mismatch - file is corrupted
+        console.error(f'ERROR: File "{file_name}" is corrupted! Checksum mismatch.\n'
+                      f'Expected: {expected_checksum[:16]}...\n'
+                      f'Received: {(received_checksum or "none")[:16]}...', peer)
+        # Delete the corrupted file
+        try:
+            if file_name and os.path.exists(file_name):
+                os.remove(file_name)
+                console.emit(f'Corrupted file "{file_name}" has been deleted.', peer=peer)
+        except Exception as e:
+            console.error(f'Warning: Could not delete corrupted file: {e}', peer)
+        return False
+
+def _remove_partial(file_name, peer):
+    """Delete a file that was not received completely"""
+    try:
+        os.remove(file_name)
     except OSError as e:
-        print(f'Error: failed to send to {cid}: {e}')
-        # Remove the connection if it's broken
-        conn_manager.remove_connection(cid)
+        console.error(f'Warning: Could not delete partial file "{file_name}": {e}', peer)
 
+def _ack_file(conn_manager, conn_id, checksum, verified):
+    """Tell a sender that supports acks whether its file arrived intact"""
+    if conn_manager is None:
+        return
+    if 'ack' in conn_manager.get_connection(conn_id).get('peer_caps', ()):
+        conn_manager.send_control(conn_id, f'__FACK__ {checksum} {"ok" if verified else "bad"}\n')
 
-def start_receiver_thread(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
+def start_receiver_thread(sock, peer_ip, peer_port, on_socket_close, conn_id=None, conn_manager=None):
     t = threading.Thread(target=_receiver_loop,
-                         args=(sock, peer_ip, peer_port, on_socket_close, conn_id),
+                         args=(sock, peer_ip, peer_port, on_socket_close, conn_id, conn_manager),
                          daemon=True)
     t.start()
     return t
 
-def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
-    buf = b''
+def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None, conn_manager=None):
+    peer = f'{peer_ip}:{peer_port}'
+    buf = bytearray()
+    # descriptors passed over a Unix socket, waiting for their __FILEFD__ header
+    pending_fds = deque()
+    # memory accounting: `held` bytes of the receive budget belong to this
+    # connection (unconsumed data in buf plus the pending recv)
+    budget = conn_manager.receive_budget if conn_manager is not None else _default_budget
+    held = 0
+    stalled_since = None
+    # client-side TLS sessions are cached once the server's ticket has arrived
+    session_saved = False
 
     # state for file receiving
     receiving_file = False
@@ -82,10 +188,35 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
     try:
         # prevent blocking forever
         sock.settimeout(1.0)
+        poller = None
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
 
         while True:
             try:
-                data = sock.recv(4096)
+                if not _wait_readable(sock, poller, 1.0):
+                    # nothing to read yet; same as a recv timeout
+                    raise socket.timeout
+                want = budget.recv_size(len(buf))
+                if want == 0:
+                    # buffer full of data we cannot consume yet
+                    console.error(f'Closing connection from {peer_ip}:{peer_port}: receive buffer limit exceeded.', peer)
+                    break
+                want = budget.reserve(want, timeout=1.0)
+                if not want:
+                    # node-wide budget exhausted: stop reading (backpressure),
+                    # and only give up if we are sitting on a partial line
+                    if stalled_since is None:
+                        stalled_since = time.monotonic()
+                    elif buf and time.monotonic() - stalled_since > STALL_TIMEOUT:
+                        console.error(f'Closing connection from {peer_ip}:{peer_port}: receive memory budget exhausted.', peer)
+                        break
+                    continue
+                stalled_since = None
+                held += want
+
+                data = local_transport.recv(sock, want, pending_fds)
                 if not data:  # peer closed
                     # Clean up any partially received file
                     if receiving_file:
@@ -95,37 +226,57 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                         if file_name and os.path.exists(file_name):
                             try:
                                 os.remove(file_name)
-                                print(f'Connection closed during file transfer. Incomplete file "{file_name}" deleted.')
+                                console.emit(f'Connection closed during file transfer. Incomplete file "{file_name}" deleted.', peer=peer)
                             except:
                                 pass
                     break
 
                 buf += data
+                if not session_saved:
+                    session_saved = tls_transport.remember_session(sock, peer_ip, peer_port)
 
                 while True:
                     # 1) if we are NOT currently receiving a file, process header/chat lines
                     if not receiving_file:
-                        i = buf.find(b'\n')
+                        i = buf.find(b'\n', 0, budget.max_line_len + 1)
                         if i == -1:
+                            if len(buf) > budget.max_line_len:
+                                raise LineTooLong(f'line longer than {budget.max_line_len} bytes')
                             # no complete line yet
                             break
 
                         line = buf[:i].decode('utf-8', 'replace')
-                        buf = buf[i+1:]  # drop this line from buffer
+                        del buf[:i+1]  # drop this line from buffer
+
+                        # chat message with a delivery receipt requested
+                        if line.startswith('__MSG__ ') and conn_manager is not None:
+                            seq, _, text = line[8:].partition(' ')
+                            conn_manager.send_control(conn_id, f'__ACK__ {seq}\n')
+                            # skip a message that already arrived over UDP
+                            seen = conn_manager.get_connection(conn_id).get('seen')
+                            if seen is None or seen.first(seq):
+                                console.message(peer_ip, peer_port, text)
+
+                        # hello, ping/pong and acknowledgements
+                        elif line.startswith(control.CONTROL_TAGS) and conn_manager is not None:
+                            control.handle(line, conn_id, conn_manager, peer)
 
                         # check if this line is a file header
-                        if line.startswith('__FILE__ '):
+                        elif line.startswith('__FILE__ ') or line.startswith('__FILEFD__ '):
                             # expected format: __FILE__ <filename> <size> <checksum>
+                            # (__FILEFD__: same fields, payload passed as a descriptor)
                             parts = line.split(' ', 3)
                             if len(parts) != 4:
-                                print('Received malformed file header.')
+                                console.error('Received malformed file header.', peer)
                                 continue
 
                             file_name_raw = parts[1]
                             try:
                                 file_bytes_remaining = int(parts[2])
+                                if file_bytes_remaining < 0:
+                                    raise ValueError
                             except ValueError:
-                                print('Received file header with invalid size.')
+                                console.error('Received file header with invalid size.', peer)
                                 continue
                             
                             expected_checksum = parts[3].strip()
@@ -134,12 +285,20 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                             file_name = os.path.basename(file_name_raw)
                             
                             # Initialize hasher for checksum verification
-                            file_hasher = hashlib.sha256()
+                            # (<algorithm>:<hex>, or bare hex for sha256)
+                            try:
+                                file_hasher = hashing.new_hasher(hashing.parse_field(expected_checksum)[0])
+                            except ValueError as e:
+                                # still take in the payload; _finish_file rejects it
+                                console.error(f'Cannot verify file "{file_name}": {e}', peer)
+                                file_hasher = None
                             
                             try:
                                 file_obj = open(file_name, 'wb')
                             except OSError as e:
-                                print(f'Error opening file "{file_name}" for writing: {e}')
+                                console.error(f'Error opening file "{file_name}" for writing: {e}', peer)
+                                if parts[0] == '__FILEFD__' and pending_fds:
+                                    os.close(pending_fds.popleft())
                                 # skip reading the file payload, but still consume bytes
                                 receiving_file = False
                                 file_obj = None
@@ -149,18 +308,60 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                                 file_hasher = None
                                 continue
 
+                            console.emit(f'Starting to receive file "{file_name}" '
+                                         f'({file_bytes_remaining} bytes) from {peer_ip}:{peer_port}', peer=peer)
+
+                            if parts[0] == '__FILEFD__':
+                                # same-host transfer: copy straight from the sender's file
+                                copied = 0
+                                copy_error = None
+                                if pending_fds:
+                                    fd = pending_fds.popleft()
+                                    if file_hasher is None:
+                                        # unknown checksum algorithm (reported above):
+                                        # nothing to verify against, so don't copy
+                                        os.close(fd)
+                                        file_obj.close()
+                                        _remove_partial(file_name, peer)
+                                        _ack_file(conn_manager, conn_id, expected_checksum, False)
+                                        file_obj = None
+                                        file_bytes_remaining = 0
+                                        file_name = None
+                                        expected_checksum = None
+                                        continue
+                                    try:
+                                        copied = local_transport.copy_from_fd(
+                                            fd, file_bytes_remaining, file_obj, file_hasher)
+                                    except OSError as e:
+                                        # e.g. ESPIPE: the descriptor is a pipe or socket, not a file
+                                        copy_error = e
+                                    finally:
+                                        os.close(fd)
+                                file_obj.close()
+                                verified = False
+                                if copied == file_bytes_remaining and copy_error is None:
+                                    verified = _finish_file(file_name, file_hasher, expected_checksum, peer_ip, peer_port)
+                                else:
+                                    reason = copy_error or f'{copied} of {file_bytes_remaining} bytes'
+                                    console.error(f'ERROR: File "{file_name}" could not be read from the sender '
+                                                  f'({reason}).', peer)
+                                    _remove_partial(file_name, peer)
+                                _ack_file(conn_manager, conn_id, expected_checksum, verified)
+                                file_obj = None
+                                file_bytes_remaining = 0
+                                file_name = None
+                                expected_checksum = None
+                                file_hasher = None
+                                continue
+
                             receiving_file = True
-                            print(f'Starting to receive file "{file_name}" '
-                                  f'({file_bytes_remaining} bytes) from {peer_ip}:{peer_port}')
                             # loop continues; next iteration will go into "receiving_file" branch
 
                         else:
                             # normal chat message (the original behavior)
-                            print(f'Message received from {peer_ip}')
-                            print(f"Sender's Port: {peer_port}")
-                            print(f'Message: "{line}"')
-                            # Play notification sound
-                            play_notification_sound()
+                            # queued for the console writer, which also plays
+                            # the notification sound
+                            console.message(peer_ip, peer_port, line)
 
                     # 2) if we ARE currently receiving a file, consume raw bytes
                     else:
@@ -175,7 +376,7 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                                     os.remove(file_name)
                                 except:
                                     pass
-                            print(f'File "{file_name}" received from {peer_ip}:{peer_port}')
+                            console.emit(f'File "{file_name}" received from {peer_ip}:{peer_port}', peer=peer)
                             receiving_file = False
                             file_obj = None
                             file_name = None
@@ -188,9 +389,9 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                             break
 
                         # write as much as we can from buf into the file
-                        chunk = buf[:file_bytes_remaining]
+                        chunk = bytes(buf[:file_bytes_remaining])
                         file_bytes_remaining -= len(chunk)
-                        buf = buf[len(chunk):]
+                        del buf[:len(chunk)]
                         
                         # Update checksum as we receive data
                         if file_hasher:
@@ -206,32 +407,8 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                                 file_obj.close()
                                 file_obj = None
                             
-                            # Calculate checksum of received data
-                            if file_hasher:
-                                received_checksum = file_hasher.hexdigest()
-                            else:
-                                # Should not happen, but handle gracefully
-                                print(f'ERROR: Checksum calculator not initialized for file "{file_name}"')
-                                received_checksum = None
-                            
-                            # Verify checksum matches
-                            if received_checksum and received_checksum == expected_checksum:
-                                print(f'File "{file_name}" received successfully from {peer_ip}:{peer_port}')
-                                print(f'Checksum verified: {received_checksum[:16]}...')
-                                # Play notification sound for successful file transfer
-                                play_notification_sound()
-                            else:
-                                # Checksum mismatch - file is corrupted
-                                print(f'ERROR: File "{file_name}" is corrupted! Checksum mismatch.')
-                                print(f'Expected: {expected_checksum[:16]}...')
-                                print(f'Received: {received_checksum[:16]}...')
-                                # Delete the corrupted file
-                                try:
-                                    if file_name and os.path.exists(file_name):
-                                        os.remove(file_name)
-                                        print(f'Corrupted file "{file_name}" has been deleted.')
-                                except Exception as e:
-                                    print(f'Warning: Could not delete corrupted file: {e}')
+                            verified = _finish_file(file_name, file_hasher, expected_checksum, peer_ip, peer_port)
+                            _ack_file(conn_manager, conn_id, expected_checksum, verified)
                             
                             # Reset state
                             receiving_file = False
@@ -241,16 +418,37 @@ def _receiver_loop(sock, peer_ip, peer_port, on_socket_close, conn_id=None):
                             file_hasher = None
                             # then we loop back and process any remaining buf as chat/header
 
+                # give back budget for whatever was consumed
+                budget.release(held - len(buf))
+                held = len(buf)
+
+                # apply receive rate limits: what arrived is already handled,
+                # only further reads wait
+                if conn_manager is not None and conn_id is not None:
+                    conn_manager.throttle_receive(conn_id, len(data))
+
             except socket.timeout:
                 # normal; just loop again and try to recv more
+                budget.release(held - len(buf))
+                held = len(buf)
+                if not session_saved:
+                    session_saved = tls_transport.remember_session(sock, peer_ip, peer_port)
                 continue
 
     except (ConnectionResetError, BrokenPipeError, OSError):
         # peer force-closed / network error
         pass
+    except LineTooLong as e:
+        # protocol limit violated; dropping the connection is the only option
+        console.error(f'Closing connection from {peer_ip}:{peer_port}: {e}', peer)
     except Exception as e:
-        print(f'Error in receiver loop: {e}')
+        console.error(f'Error in receiver loop: {e}', peer)
     finally:
+        budget.release(held)
+        for fd in pending_fds:
+            os.close(fd)
+        if not session_saved:
+            tls_transport.remember_session(sock, peer_ip, peer_port)
         # cleanup connection via callback
         try:
             if conn_id is not None:
@@ -7,20 +7,72 @@ import socket
 import sys
 import threading
 import signal
+import ssl
+import argparse
 from connection_manager import ConnectionManager
 from prince import availableOptions, connect, list, terminate, sendfile
 from Sultan import send_command, start_receiver_thread
 from bryson import get_local_ip
+from console import console, MODES as LOG_MODES, DEFAULT_FLOOD_THRESHOLD
+from rate_limiter import ratelimit_command, parse_size
+from receive_limits import ReceiveBudget, DEFAULT_GLOBAL_LIMIT, DEFAULT_CONN_LIMIT, DEFAULT_MAX_LINE_LEN
+from tls_transport import make_server_context, make_client_context, wrap_server_socket, server_handshake
+import local_transport
+import control
+import hashing
+from udp_channel import UdpChannel
+from jobs import JobManager, DEFAULT_WORKERS
 import time
 
 
 class P2PChatApp:
-    def __init__(self, listening_port):
+    def __init__(self, listening_port, certfile=None, keyfile=None, cafile=None, receive_budget=None,
+                 local_fast_path=True, workers=DEFAULT_WORKERS, udp=True,
+                 hash_algorithm=hashing.DEFAULT_ALGORITHM, plain_local=False):
         self.listening_port = listening_port
-        self.conn_manager = ConnectionManager()
+        self.local_fast_path = local_fast_path
+        self.plain_local = plain_local
+        self.udp = udp
+        self.conn_manager = ConnectionManager(receive_budget)
+        self.conn_manager.hash_algorithm = hash_algorithm
         self.server_socket = None
         self.stop_event = threading.Event()
         self.server_thread = None
+        self.local_socket = None
+        self.local_thread = None
+        self.jobs = JobManager(workers, on_finish=self._job_finished)
+        
+        # name -> (handler, min args, max args, usage, run as background job)
+        self.commands = {
+            'help': (self.cmd_help, 0, None, "help", False),
+            'myip': (self.cmd_myip, 0, None, "myip", False),
+            'myport': (self.cmd_myport, 0, None, "myport", False),
+            'connect': (self.cmd_connect, 2, 2, "connect <destination> <port>", True),
+            'list': (self.cmd_list, 0, None, "list", False),
+            'terminate': (self.cmd_terminate, 1, 1, "terminate <connection_id>", False),
+            'send': (self.cmd_send, 2, None, "send <connection_id> <message>", False),
+            'sendfile': (self.cmd_sendfile, 2, 2, "sendfile <connection_id> <filepath>", True),
+            'ratelimit': (self.cmd_ratelimit, 0, None, "ratelimit", False),
+            'log': (self.cmd_log, 0, 1, f"log [{'|'.join(LOG_MODES)}]", False),
+            'ping': (self.cmd_ping, 1, 2, "ping <connection_id> [count]", True),
+            'receipts': (self.cmd_receipts, 0, 1, "receipts [on|off]", False),
+            'hash': (self.cmd_hash, 0, 1, f"hash [{'|'.join(hashing.ALGORITHMS)}]", False),
+            'jobs': (self.cmd_jobs, 0, 0, "jobs", False),
+            'wait': (self.cmd_wait, 1, 1, "wait <job_id>", False),
+            'cancel': (self.cmd_cancel, 1, 1, "cancel <job_id>", False),
+            'exit': (self.cmd_exit, 0, None, "exit", False),
+        }
+        
+        # Optional TLS: accepted connections use the server context, outgoing
+        # ones the client context (which trusts cafile, or our own cert)
+        self.tls_server_context = None
+        self.tls_client_context = None
+        if certfile and keyfile:
+            self.tls_server_context = make_server_context(certfile, keyfile)
+            self.tls_client_context = make_client_context(cafile or certfile)
+            # the Unix socket carries plaintext: only with an explicit opt-in
+            if not plain_local:
+                self.local_fast_path = False
         
     def start_server(self):
         """Start the server to accept incoming connections"""
@@ -29,101 +81,254 @@ class P2PChatApp:
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind(('', self.listening_port))
             self.server_socket.listen(5)
-            print(f"Server listening on port {self.listening_port}")
+            mode = " (TLS)" if self.tls_server_context else ""
+            console.emit(f"Server listening on port {self.listening_port}{mode}")
+            
+            # UDP side channel for chat messages on the same port number
+            if self.udp:
+                try:
+                    self.conn_manager.udp = UdpChannel(self.listening_port, self.conn_manager)
+                except OSError as e:
+                    console.error(f"UDP port {self.listening_port} unavailable, messages will use TCP: {e}")
+            
+            # Same-host fast path, only once the TCP port is really ours
+            if self.local_fast_path:
+                self.local_thread = threading.Thread(target=self.start_local_server, daemon=True)
+                self.local_thread.start()
             
             while not self.stop_event.is_set():
                 try:
                     self.server_socket.settimeout(1.0)
                     conn, addr = self.server_socket.accept()
                     
-                    # Add incoming connection to manager
-                    conn_id = self.conn_manager.add_connection(conn, addr[0], addr[1])
+                    if self.tls_server_context is not None:
+                        # handshake on the connection's own thread, so one
+                        # silent client cannot hold up the next accept
+                        threading.Thread(target=self.accept_tls, daemon=True,
+                                         args=(conn, addr[0], addr[1])).start()
+                        continue
                     
-                    # Start receiver thread for incoming connection
-                    thread = start_receiver_thread(conn, addr[0], addr[1], 
-                                                lambda conn_id: self.conn_manager.remove_connection(conn_id), conn_id)
-                    self.conn_manager.set_receiver_thread(conn_id, thread)
-                    
-                    print(f"✓ Connection established from {addr[0]}:{addr[1]} (ID: {conn_id})")
+                    self.register_incoming(conn, addr[0], addr[1])
                     
                 except socket.timeout:
                     continue
                 except Exception as e:
                     if not self.stop_event.is_set():
-                        print(f"Server error: {e}")
+                        console.error(f"Server error: {e}")
                     break
                     
         except Exception as e:
-            print(f"Failed to start server on port {self.listening_port}: {e}")
+            console.error(f"Failed to start server on port {self.listening_port}: {e}")
             self.stop_event.set()
     
+    def accept_tls(self, conn, peer_ip, peer_port):
+        """Complete the TLS handshake of an accepted socket, then register it"""
+        try:
+            conn = wrap_server_socket(conn, self.tls_server_context)
+            server_handshake(conn)
+        except (ssl.SSLError, OSError) as e:
+            console.error(f"TLS handshake failed with {peer_ip}:{peer_port}: {e}", f"{peer_ip}:{peer_port}")
+            conn.close()
+            return
+        if self.stop_event.is_set():
+            conn.close()
+            return
+        self.register_incoming(conn, peer_ip, peer_port)
+    
+    def register_incoming(self, conn, peer_ip, peer_port):
+        """Track an accepted connection and start its receiver thread"""
+        # Add incoming connection to manager
+        conn_id = self.conn_manager.add_connection(conn, peer_ip, peer_port)
+        
+        # Start receiver thread for incoming connection
+        thread = start_receiver_thread(conn, peer_ip, peer_port, 
+                                    lambda conn_id: self.conn_manager.remove_connection(conn_id), conn_id,
+                                    self.conn_manager)
+        self.conn_manager.set_receiver_thread(conn_id, thread)
+        
+        console.emit(f"✓ Connection established from {peer_ip}:{peer_port} (ID: {conn_id})",
+                     peer=f"{peer_ip}:{peer_port}")
+    
+    def start_local_server(self):
+        """Accept same-host connections on the Unix socket for our port"""
+        try:
+            self.local_socket = local_transport.listen(self.listening_port)
+        except OSError as e:
+            console.error(f"Local socket unavailable, same-host peers will use TCP: {e}")
+            return
+        if self.local_socket is None:
+            return
+        
+        self.local_socket.settimeout(1.0)
+        while not self.stop_event.is_set():
+            try:
+                conn, _ = self.local_socket.accept()
+                if not local_transport.same_user(conn):
+                    console.error("Rejected local connection from another user")
+                    conn.close()
+                    continue
+                # Unix peers have no address; show them as loopback
+                self.register_incoming(conn, '127.0.0.1', 0)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if not self.stop_event.is_set():
+                    console.error(f"Local server error: {e}")
+                break
+    
     def handle_command(self, line):
-        """Handle user commands"""
+        """
+        Handle user commands. Slow commands (connect, sendfile) are started as
+        background jobs and report back through the console when they finish.
+        Returns True when the application should exit.
+        """
         if not line.strip():
             return
             
         parts = line.strip().split()
         cmd = parts[0].lower()
         
+        if cmd not in self.commands:
+            print(f"Unknown command: {cmd}")
+            print(availableOptions())
+            return False
+        
+        handler, min_args, max_args, usage, background = self.commands[cmd]
+        nargs = len(parts) - 1
+        if nargs < min_args or (max_args is not None and nargs > max_args):
+            print(f"Usage: {usage}")
+            return False
+        
         try:
-            if cmd == 'help':
-                print(availableOptions())
-                
-            elif cmd == 'myip':
-                print(get_local_ip())
-                
-            elif cmd == 'myport':
-                print(self.listening_port)
-                
-            elif cmd == 'connect':
-                if len(parts) != 3:
-                    print("Usage: connect <destination> <port>")
-                    return
-                result = connect(parts[1], parts[2], self.conn_manager, get_local_ip(), self.listening_port)
-                print(result.strip())
-                
-            elif cmd == 'list':
-                result = list(self.conn_manager.get_all_connections())
-                print(result.strip())
-                
-            elif cmd == 'terminate':
-                if len(parts) != 2:
-                    print("Usage: terminate <connection_id>")
-                    return
-                result = terminate(parts[1], self.conn_manager.get_all_connections())
-                print(result.strip())
-                
-            elif cmd == 'send':
-                if len(parts) < 3:
-                    print("Usage: send <connection_id> <message>")
-                    return
-                send_command(line, self.conn_manager)
-                
-            elif cmd == 'sendfile':
-                if len(parts) != 3:
-                    print("Usage: sendfile <connection_id> <filepath>")
-                    return
-                result = sendfile(parts[1], parts[2], self.conn_manager)
-                print(result.strip())
-                
-            elif cmd == 'exit':
-                print("Exiting...")
-                self.stop_event.set()
-                self.cleanup()
+            if background:
+                self.jobs.prune()
+                job = self.jobs.submit(line.strip(), lambda job: handler(parts, line, job))
+                print(f"[job {job.id}] {line.strip()}")
+                return False
+            
+            result = handler(parts, line)
+            if result is True:
                 return True
-                
-            else:
-                print(f"Unknown command: {cmd}")
-                print(availableOptions())
+            if result:
+                print(result.strip())
                 
         except Exception as e:
             print(f"Error executing command: {e}")
             
         return False
     
+    def _job_finished(self, job):
+        """Report a background job's outcome"""
+        result = job.result.strip()
+        kind = 'error' if job.status == 'failed' or result.startswith('Error') else 'info'
+        console.emit(f"[job {job.id}] {job.status}: {result or job.command}", kind=kind)
+    
+    def cmd_help(self, parts, line):
+        return availableOptions()
+    
+    def cmd_myip(self, parts, line):
+        return get_local_ip()
+    
+    def cmd_myport(self, parts, line):
+        return str(self.listening_port)
+    
+    def cmd_connect(self, parts, line, job=None):
+        return connect(parts[1], parts[2], self.conn_manager, get_local_ip(), self.listening_port,
+                       tls_context=self.tls_client_context, local_fast_path=self.local_fast_path,
+                       plain_local=self.plain_local,
+                       cancel_event=job.cancel_event if job else None)
+    
+    def cmd_list(self, parts, line):
+        return list(self.conn_manager.get_all_connections())
+    
+    def cmd_terminate(self, parts, line):
+        return terminate(parts[1], self.conn_manager.get_all_connections())
+    
+    def cmd_send(self, parts, line):
+        send_command(line, self.conn_manager)
+    
+    def cmd_sendfile(self, parts, line, job=None):
+        return sendfile(parts[1], parts[2], self.conn_manager,
+                        progress=job.progress if job else None,
+                        cancel_event=job.cancel_event if job else None)
+    
+    def cmd_ratelimit(self, parts, line):
+        return ratelimit_command(parts[1:], self.conn_manager)
+    
+    def cmd_log(self, parts, line):
+        if len(parts) == 1:
+            return f"Log mode: {console.mode}"
+        if parts[1].lower() not in LOG_MODES:
+            return f"Usage: log [{'|'.join(LOG_MODES)}]"
+        console.set_mode(parts[1].lower())
+        return f"Log mode set to {console.mode}"
+    
+    def cmd_ping(self, parts, line, job=None):
+        try:
+            conn_id = int(parts[1])
+            count = int(parts[2]) if len(parts) == 3 else 5
+        except ValueError:
+            return "Error: Connection ID and count must be integers"
+        if not 1 <= count <= 10000:
+            return "Error: Count must be between 1 and 10000"
+        return control.ping(conn_id, self.conn_manager, count,
+                            cancel_event=job.cancel_event if job else None)
+    
+    def cmd_receipts(self, parts, line):
+        if len(parts) == 2:
+            if parts[1].lower() not in ('on', 'off'):
+                return "Usage: receipts [on|off]"
+            self.conn_manager.acks.receipts = parts[1].lower() == 'on'
+        return f"Delivery receipts {'on' if self.conn_manager.acks.receipts else 'off'}"
+    
+    def cmd_hash(self, parts, line):
+        if len(parts) == 2:
+            if parts[1] not in hashing.ALGORITHMS:
+                return f"Usage: hash [{'|'.join(hashing.ALGORITHMS)}]"
+            self.conn_manager.hash_algorithm = parts[1]
+        return (f"Checksum algorithm for sent files: {self.conn_manager.hash_algorithm} "
+                f"(sha256 for peers that do not accept it)")
+    
+    def cmd_jobs(self, parts, line):
+        jobs = self.jobs.get_all()
+        if not jobs:
+            return "No jobs."
+        return '\n'.join(job.describe() for job in jobs.values())
+    
+    def _get_job(self, job_id):
+        try:
+            return self.jobs.get(int(job_id))
+        except ValueError:
+            return None
+    
+    def cmd_wait(self, parts, line):
+        job = self._get_job(parts[1])
+        if job is None:
+            return f"Error: No job with id {parts[1]}"
+        # show progress while waiting on a transfer
+        while not job.done_event.wait(1.0):
+            if job.bytes_total:
+                print(job.describe())
+        return job.describe() + (f"\n{job.result.strip()}" if job.result else '')
+    
+    def cmd_cancel(self, parts, line):
+        job = self._get_job(parts[1])
+        if job is None:
+            return f"Error: No job with id {parts[1]}"
+        if not self.jobs.cancel(job.id):
+            return f"Job {job.id} already {job.status}"
+        return f"Cancelling job {job.id}"
+    
+    def cmd_exit(self, parts, line):
+        print("Exiting...")
+        self.stop_event.set()
+        self.cleanup()
+        return True
+    
     def cleanup(self):
         """Clean up resources"""
         self.stop_event.set()
+        self.jobs.shutdown()
         
         # Close server socket
         if self.server_socket:
@@ -132,8 +337,16 @@ class P2PChatApp:
             except:
                 pass
         
+        if self.local_socket:
+            local_transport.close_listener(self.local_socket, self.listening_port)
+            self.local_socket = None
+        
+        if self.conn_manager.udp is not None:
+            self.conn_manager.udp.close()
+        
         # Close all connections
         self.conn_manager.close_all_connections()
+        console.flush()
         
         # Wait for server thread to finish
         if self.server_thread and self.server_thread.is_alive():
@@ -150,6 +363,7 @@ class P2PChatApp:
         time.sleep(0.5)
         
         if self.stop_event.is_set():
+            console.flush()
             print("Failed to start server. Exiting.")
             return
         
@@ -176,13 +390,43 @@ def signal_handler(signum, frame):
     sys.exit(0)
 
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='main.py', description='P2P chat application')
+    parser.add_argument('listening_port')
+    parser.add_argument('--tls', nargs=2, metavar=('CERTFILE', 'KEYFILE'),
+                        help='encrypt connections with this certificate and key')
+    parser.add_argument('--cafile',
+                        help='certificates to trust when connecting (default: the --tls certificate)')
+    parser.add_argument('--recv-budget', type=parse_size, default=DEFAULT_GLOBAL_LIMIT,
+                        help='memory for unprocessed received data across all connections (default: 64MB)')
+    parser.add_argument('--conn-buffer', type=parse_size, default=DEFAULT_CONN_LIMIT,
+                        help='receive buffer limit per connection (default: 256KB)')
+    parser.add_argument('--max-line', type=parse_size, default=DEFAULT_MAX_LINE_LEN,
+                        help='longest message or file header line accepted (default: 8KB)')
+    parser.add_argument('--no-local', action='store_true',
+                        help='always use TCP, even to instances on this machine')
+    parser.add_argument('--plain-local', action='store_true',
+                        help='with --tls, still use the unencrypted Unix socket for '
+                             'instances on this machine')
+    parser.add_argument('--no-udp', action='store_true',
+                        help='send chat messages over TCP only (no UDP side channel)')
+    parser.add_argument('--hash', choices=hashing.ALGORITHMS, default=hashing.DEFAULT_ALGORITHM,
+                        help='checksum algorithm for sent files, if the receiver accepts it '
+                             '(tree variants hash on all cores)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='threads for background jobs such as connect and sendfile (default: 8)')
+    parser.add_argument('--log-mode', choices=LOG_MODES, default='normal',
+                        help='normal, quiet (errors and summaries only) or json (one object per line)')
+    parser.add_argument('--flood-threshold', type=int, default=DEFAULT_FLOOD_THRESHOLD,
+                        help='messages per peer per second shown before summarizing (0 = never summarize)')
+    return parser.parse_args(argv)
+
+
 def main():
-    if len(sys.argv) != 2:
-        print('Usage: python3 main.py <listening_port>')
-        sys.exit(1)
+    args = parse_args(sys.argv[1:])
     
     try:
-        port = int(sys.argv[1])
+        port = int(args.listening_port)
         if port < 1 or port > 65535:
             print("Port must be between 1 and 65535")
             sys.exit(1)
@@ -190,11 +434,32 @@ def main():
         print("Port must be an integer")
         sys.exit(1)
     
+    console.set_mode(args.log_mode)
+    console.flood_threshold = args.flood_threshold
+    
+    certfile, keyfile = args.tls if args.tls else (None, None)
+    if args.cafile and not args.tls:
+        print("--cafile requires --tls")
+        sys.exit(1)
+    
     # Set up signal handler for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
     
     # Create and run the application
-    app = P2PChatApp(port)
+    try:
+        receive_budget = ReceiveBudget(args.recv_budget, args.conn_buffer, args.max_line)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    
+    try:
+        app = P2PChatApp(port, certfile, keyfile, args.cafile, receive_budget,
+                         local_fast_path=not args.no_local, workers=args.workers,
+                         plain_local=args.plain_local,
+                         udp=not args.no_udp, hash_algorithm=args.hash)
+    except (ssl.SSLError, OSError) as e:
+        print(f"Failed to load TLS certificate: {e}")
+        sys.exit(1)
     app.run()
 
 
@@ -4,14 +4,41 @@ Connection Manager for tracking all active connections
 """
 
 import socket
+import ssl
 import threading
+import time
 from typing import Dict, Any
+from tls_transport import RecordWriter
+from rate_limiter import TokenBucket, FairScheduler
+from receive_limits import ReceiveBudget
+from console import console
+from control import AckTracker, RttStats, hello_line
+from udp_channel import RecentSeqs, new_token
+from hashing import DEFAULT_ALGORITHM
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, receive_budget: ReceiveBudget = None):
         self.connections: Dict[int, Dict[str, Any]] = {}
         self.next_connection_id = 1
         self.lock = threading.Lock()
+        
+        # Global bandwidth limits (unlimited until configured with `ratelimit`)
+        self.global_send_bucket = TokenBucket()
+        self.global_recv_bucket = TokenBucket()
+        self.scheduler = FairScheduler(self.global_send_bucket)
+        
+        # Caps on unprocessed received data, shared by all receiver threads
+        self.receive_budget = receive_budget or ReceiveBudget()
+        
+        # Outstanding pings and delivery acknowledgements
+        self.acks = AckTracker(lambda conn_id: self.get_connection(conn_id).get('rtt'))
+        
+        # UDP side channel for chat messages (a UdpChannel, set by the app)
+        self.udp = None
+        self.udp_tokens: Dict[str, int] = {}
+        
+        # Checksum algorithm for files we send, when the receiver accepts it
+        self.hash_algorithm = DEFAULT_ALGORITHM
     
     def add_connection(self, sock: socket.socket, peer_ip: str, peer_port: int) -> int:
         """Add a new connection and return its ID"""
@@ -19,13 +46,36 @@ class ConnectionManager:
             conn_id = self.next_connection_id
             self.next_connection_id += 1
             
+            # Offer the UDP channel on plain connections only; datagrams are not encrypted
+            udp_token = None
+            if self.udp is not None and not isinstance(sock, ssl.SSLSocket):
+                udp_token = new_token()
+                self.udp_tokens[udp_token] = conn_id
+            
+            send_bucket = TokenBucket()
+            throttle = lambda nbytes, interactive: self.scheduler.acquire(
+                conn_id, nbytes, send_bucket, interactive)
+            
             self.connections[conn_id] = {
                 'sock': sock,
+                'writer': RecordWriter(sock, throttle=throttle),  # serialized, record-sized sends
                 'ip': peer_ip,
                 'port': peer_port,
+                'send_bucket': send_bucket,
+                'recv_bucket': TokenBucket(),
+                'peer_caps': set(),  # filled in by the peer's __HELLO__
+                'peer_hello': {},
+                'rtt': RttStats(),
+                'seen': RecentSeqs(),  # message seqs already shown
+                'udp_token': udp_token,  # our token; the peer's is in peer_hello
+                'udp_ok': udp_token is not None,
                 'thread': None  # Will store receiver thread reference
             }
-            return conn_id
+        
+        # Advertise what we support; old peers just print it once
+        extra = {'udp': self.udp.port, 'udptoken': udp_token} if udp_token else None
+        self.send_control(conn_id, hello_line(extra))
+        return conn_id
     
     def remove_connection(self, conn_id: int) -> bool:
         """Remove a connection by ID"""
@@ -37,9 +87,13 @@ class ConnectionManager:
                 except:
                     pass
                 del self.connections[conn_id]
-                print(f"Connection {conn_id} closed")
-                return True
-            return False
+                self.udp_tokens.pop(conn_info['udp_token'], None)
+            else:
+                return False
+        # outside the lock: forget() runs callbacks that may look up connections
+        self.acks.forget(conn_id)
+        console.emit(f"Connection {conn_id} closed", peer=f"{conn_info['ip']}:{conn_info['port']}")
+        return True
     
     def get_connection(self, conn_id: int) -> Dict[str, Any]:
         """Get connection info by ID"""
@@ -60,6 +114,70 @@ class ConnectionManager:
                 except:
                     pass
             self.connections.clear()
+            self.udp_tokens.clear()
+    
+    def send_control(self, conn_id, text: str) -> bool:
+        """Send a control line without blocking behind a transfer; False on failure"""
+        conn_info = self.get_connection(conn_id)
+        if not conn_info:
+            return False
+        try:
+            conn_info['writer'].send_nowait(text.encode('utf-8'))
+            return True
+        except OSError:
+            return False
+    
+    def find_udp_token(self, token):
+        """Connection ID a UDP token was issued for, or None"""
+        with self.lock:
+            return self.udp_tokens.get(token)
+    
+    def set_udp_ok(self, conn_id, ok: bool) -> bool:
+        """Enable or disable UDP messages on a connection; returns the previous setting"""
+        with self.lock:
+            conn_info = self.connections.get(conn_id)
+            if conn_info is None:
+                return False
+            previous = conn_info['udp_ok']
+            conn_info['udp_ok'] = ok
+            return previous
+    
+    def set_peer_hello(self, conn_id, fields):
+        """Record the capabilities a peer announced"""
+        with self.lock:
+            if conn_id in self.connections:
+                self.connections[conn_id]['peer_hello'] = fields
+                self.connections[conn_id]['peer_caps'] = fields['caps']
+    
+    def set_rate_limit(self, conn_id, direction: str, rate) -> bool:
+        """
+        Set a bandwidth limit in bytes/s (None = unlimited).
+        conn_id: connection ID, or None for the global limit
+        direction: 'send', 'recv' or 'both'
+        """
+        if conn_id is None:
+            buckets = {'send': self.global_send_bucket, 'recv': self.global_recv_bucket}
+        else:
+            conn_info = self.get_connection(conn_id)
+            if not conn_info:
+                return False
+            buckets = {'send': conn_info['send_bucket'], 'recv': conn_info['recv_bucket']}
+        for name, bucket in buckets.items():
+            if direction in (name, 'both'):
+                bucket.set_rate(rate)
+        return True
+    
+    def throttle_receive(self, conn_id, nbytes: int):
+        """
+        Charge nbytes received on a connection and sleep off any excess. Not
+        reading from the socket meanwhile lets TCP flow control slow the peer.
+        """
+        conn_info = self.get_connection(conn_id)
+        pause = self.global_recv_bucket.throttle(nbytes)
+        if conn_info:
+            pause = max(pause, conn_info['recv_bucket'].throttle(nbytes))
+        if pause > 0:
+            time.sleep(pause)
     
     def set_receiver_thread(self, conn_id: int, thread: threading.Thread):
         """Set the receiver thread for a connection"""
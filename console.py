@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Console sink: receiver and server threads hand their output to a queue and
+a single writer thread prints it in batches, so they never block on the
+terminal and lines from different peers never interleave.
+"""
+
+import json
+import queue
+import sys
+import threading
+import time
+
+MODES = ('normal', 'quiet', 'json')
+
+# Kinds still shown in quiet mode
+_QUIET_KINDS = ('error', 'summary')
+
+DEFAULT_FLOOD_THRESHOLD = 20
+FLOOD_WINDOW = 1.0
+MAX_QUEUED = 100000
+MAX_BATCH = 1000
+
+
+class ConsoleSink:
+    """
+    Queue-backed output for background threads.
+    mode: 'normal' (human readable), 'quiet' (errors and summaries only) or
+          'json' (one JSON object per line)
+    flood_threshold: messages per peer per second shown individually before
+                     the rest are folded into a summary line; 0 disables
+    notify: called at most once per batch that contains a chat message or a
+            received file (e.g. to play a sound)
+    """
+
+    def __init__(self, stream=None, mode='normal', flood_threshold=DEFAULT_FLOOD_THRESHOLD,
+                 notify=None):
+        self.stream = stream
+        self.mode = mode
+        self.flood_threshold = flood_threshold
+        self.notify = notify
+        self.queue = queue.Queue(MAX_QUEUED)
+        self.dropped = 0
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+        # flood accounting, only touched by the writer thread
+        self.window_start = time.monotonic()
+        self.window_counts = {}
+        self.window_suppressed = {}
+
+    def set_mode(self, mode):
+        if mode not in MODES:
+            raise ValueError(f"unknown log mode '{mode}' (expected one of: {', '.join(MODES)})")
+        self.mode = mode
+
+    def emit(self, text, kind='info', peer=None, alert=False, display=None):
+        """
+        Queue a line for output; never blocks.
+        kind: 'info', 'error', 'message' or 'summary'
+        peer: "ip:port" the line is about, used for flood summaries
+        alert: trigger the notify callback
+        display: human-readable form, if different from text (json mode
+                 always logs text)
+        """
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((time.time(), kind, peer, text, alert, display))
+        except queue.Full:
+            # the writer cannot keep up; count instead of blocking the caller
+            self.dropped += 1
+
+    def message(self, peer_ip, peer_port, text):
+        """Queue a received chat message"""
+        self.emit(text, kind='message', peer=f'{peer_ip}:{peer_port}', alert=True,
+                  display=(f'Message received from {peer_ip}\n'
+                           f"Sender's Port: {peer_port}\n"
+                           f'Message: "{text}"'))
+
+    def error(self, text, peer=None):
+        self.emit(text, kind='error', peer=peer)
+
+    def flush(self, timeout=2.0):
+        """Wait (briefly) until everything queued so far has been written"""
+        if self.thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _ensure_started(self):
+        if self.thread is not None:
+            return
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=FLOOD_WINDOW)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            out = []
+            alert = False
+            for stamp, kind, peer, text, item_alert, display in batch:
+                if kind == 'message' and self._suppress(peer):
+                    continue
+                alert = alert or item_alert
+                self._format(out, stamp, kind, peer, text, display)
+            self._roll_window(out)
+
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self._format(out, time.time(), 'summary', None,
+                             f'{dropped} lines dropped (console could not keep up)')
+
+            try:
+                if out:
+                    stream = self.stream or sys.stdout
+                    stream.write(''.join(out))
+                    stream.flush()
+                if alert and self.notify is not None and self.mode != 'quiet':
+                    self.notify()
+            except Exception:
+                pass
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _suppress(self, peer):
+        """Count a message from peer; True if it falls over the flood threshold"""
+        if not self.flood_threshold or peer is None:
+            return False
+        count = self.window_counts.get(peer, 0) + 1
+        self.window_counts[peer] = count
+        if count <= self.flood_threshold:
+            return False
+        self.window_suppressed[peer] = self.window_suppressed.get(peer, 0) + 1
+        return True
+
+    def _roll_window(self, out):
+        now = time.monotonic()
+        if now - self.window_start < FLOOD_WINDOW:
+            return
+        for peer, suppressed in self.window_suppressed.items():
+            total = self.window_counts[peer]
+            self._format(out, time.time(), 'summary', peer,
+                         f'{total} messages from {peer} in the last second '
+                         f'({suppressed} not shown)')
+        self.window_start = now
+        self.window_counts.clear()
+        self.window_suppressed.clear()
+
+    def _format(self, out, stamp, kind, peer, text, display=None):
+        if self.mode == 'json':
+            record = {'ts': round(stamp, 6), 'kind': kind, 'text': text}
+            if peer is not None:
+                record['peer'] = peer
+            out.append(json.dumps(record) + '\n')
+        elif self.mode == 'normal' or kind in _QUIET_KINDS:
+            out.append((display or text) + '\n')
+
+
+# Shared sink for the whole process
+console = ConsoleSink()
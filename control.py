@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Control messages exchanged between nodes alongside chat and files:
+capability hello, ping/pong, and delivery acknowledgements for messages and
+files. Peers that never send a hello are treated as plain chat peers and
+only ever receive plain messages.
+
+    __HELLO__ caps=ping,ack hash=sha256,...
+                                  capabilities, sent once per connection
+    __PING__ <seq>                answered with __PONG__ <seq>
+    __MSG__ <seq> <text>          chat message, answered with __ACK__ <seq>
+    __FACK__ <checksum> ok|bad    receiver's verdict on a completed file
+"""
+
+import heapq
+import itertools
+import statistics
+import threading
+import time
+from collections import deque
+
+from console import console
+from hashing import ALGORITHMS as HASH_ALGORITHMS
+
+CAPABILITIES = ('ping', 'ack')
+CONTROL_TAGS = ('__HELLO__ ', '__PING__ ', '__PONG__ ', '__ACK__ ', '__FACK__ ')
+
+MESSAGE_ACK_TIMEOUT = 10.0
+FILE_ACK_TIMEOUT = 60.0
+PING_TIMEOUT = 2.0
+PING_INTERVAL = 0.2
+
+# Smoothed RTT above which a peer is reported as slow
+SLOW_RTT = 0.5
+RTT_SAMPLES = 100
+
+
+def hello_line(extra=None):
+    """The hello we send; extra adds key=value fields"""
+    fields = {'caps': ','.join(CAPABILITIES), 'hash': ','.join(HASH_ALGORITHMS)}
+    fields.update(extra or {})
+    return '__HELLO__ ' + ' '.join(f'{k}={v}' for k, v in fields.items()) + '\n'
+
+
+def parse_hello(line):
+    """Fields of a hello line as a dict; 'caps' becomes a set"""
+    fields = {}
+    for token in line.split()[1:]:
+        key, _, value = token.partition('=')
+        fields[key] = value
+    fields['caps'] = set(filter(None, fields.get('caps', '').split(',')))
+    return fields
+
+
+class RttStats:
+    """Round-trip statistics for one connection (RFC 6298 smoothing)"""
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = deque(maxlen=RTT_SAMPLES)
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def add(self, rtt):
+        with self.lock:
+            self.samples.append(rtt)
+            self.timeouts = 0  # count consecutive misses only
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    @property
+    def slow(self):
+        return (self.srtt is not None and self.srtt > SLOW_RTT) or self.timeouts > 0
+
+    def describe(self):
+        parts = []
+        if self.srtt is not None:
+            parts.append(f'rtt {self.srtt * 1000:.1f}ms')
+        if self.timeouts:
+            # a peer that never answered has no sample but is still flagged
+            parts.append(f'{self.timeouts} unacked')
+        if not parts:
+            return ''
+        return ', '.join(parts) + (' (slow)' if self.slow else '')
+
+
+def summarize(rtts, sent):
+    """ping-style summary of a list of RTTs in seconds"""
+    received = len(rtts)
+    loss = 100 * (sent - received) / sent if sent else 0
+    text = f'{sent} pings sent, {received} replies, {loss:.0f}% loss'
+    if rtts:
+        ordered = sorted(rtts)
+        p99 = ordered[min(len(ordered) - 1, int(round(0.99 * (len(ordered) - 1))))]
+        text += (f'\nrtt min/avg/p99/max = {ordered[0] * 1000:.3f}/'
+                 f'{statistics.fmean(ordered) * 1000:.3f}/{p99 * 1000:.3f}/'
+                 f'{ordered[-1] * 1000:.3f} ms')
+    return text
+
+
+class AckTracker:
+    """
+    Outstanding acknowledgements, keyed by (conn_id, key). Lookups on ack are
+    O(1); deadlines sit in a heap swept by one timer thread, so thousands of
+    in-flight messages cost no polling.
+    """
+
+    def __init__(self, get_stats):
+        # get_stats(conn_id) -> RttStats or None
+        self.get_stats = get_stats
+        self.pending = {}
+        self.deadlines = []
+        self.seq = itertools.count(1)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.receipts = False  # print confirmations, not just failures
+
+    def next_seq(self):
+        return str(next(self.seq))
+
+    def register(self, conn_id, key, description, timeout, on_done=None, rtt_sample=True):
+        """
+        Expect an ack for key on conn_id within timeout seconds (None: no
+        deadline until rearm(), e.g. while a file is still being sent).
+        on_done(rtt, ok) is called on ack (ok True/False) or timeout (rtt None).
+        rtt_sample: whether the round trip feeds the connection's RTT stats
+                    (not for files, whose ack follows the whole transfer)
+        """
+        with self.cond:
+            now = time.monotonic()
+            deadline = now + timeout if timeout is not None else None
+            self.pending[(conn_id, key)] = [now, deadline, description, on_done, rtt_sample]
+            if deadline is not None:
+                heapq.heappush(self.deadlines, (deadline, conn_id, key))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sweep, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def rearm(self, conn_id, key, timeout):
+        """Restart the timeout of an outstanding ack, e.g. once a file is fully sent"""
+        with self.cond:
+            entry = self.pending.get((conn_id, key))
+            if entry is not None:
+                entry[1] = time.monotonic() + timeout
+                heapq.heappush(self.deadlines, (entry[1], conn_id, key))
+                self.cond.notify()
+
+    def resolve(self, conn_id, key, ok=True):
+        """Handle an incoming ack; returns the RTT, or None if nothing was waiting"""
+        with self.cond:
+            entry = self.pending.pop((conn_id, key), None)
+        if entry is None:
+            return None
+        sent, _deadline, description, on_done, rtt_sample = entry
+        rtt = time.monotonic() - sent
+        stats = self.get_stats(conn_id)
+        if stats is not None and rtt_sample:
+            stats.add(rtt)
+        if on_done is not None:
+            on_done(rtt, ok)
+        elif not ok:
+            console.error(f'{description} was rejected by connection {conn_id}')
+        elif self.receipts:
+            console.emit(f'{description} confirmed by connection {conn_id} ({rtt * 1000:.1f} ms)')
+        return rtt
+
+    def forget(self, conn_id):
+        """
+        Drop everything outstanding for a closed connection. Callbacks still
+        run (as failures) so nobody waits on an ack that cannot come.
+        """
+        with self.cond:
+            dropped = [self.pending.pop(k) for k in [k for k in self.pending if k[0] == conn_id]]
+        for _sent, _deadline, _description, on_done, _sample in dropped:
+            if on_done is not None:
+                on_done(None, False)
+
+    def _sweep(self):
+        while True:
+            expired = []
+            with self.cond:
+                while not self.deadlines:
+                    self.cond.wait()
+                deadline, conn_id, key = self.deadlines[0]
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.deadlines)
+                entry = self.pending.get((conn_id, key))
+                # skip acks already resolved and deadlines moved by rearm()
+                if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                    del self.pending[(conn_id, key)]
+                    expired.append((conn_id, entry))
+            for conn_id, (_sent, _deadline, description, on_done, _sample) in expired:
+                stats = self.get_stats(conn_id)
+                if stats is not None:
+                    stats.timed_out()
+                if on_done is not None:
+                    on_done(None, False)
+                else:
+                    console.error(f'{description} to connection {conn_id} was not acknowledged')
+
+
+def handle(line, conn_id, conn_manager, peer):
+    """Act on a control line received from conn_id"""
+    tag = line.split(' ', 1)[0]
+    if tag == '__HELLO__':
+        conn_manager.set_peer_hello(conn_id, parse_hello(line))
+    elif tag == '__PING__':
+        conn_manager.send_control(conn_id, f'__PONG__ {line[9:].strip()}\n')
+    elif tag == '__PONG__':
+        conn_manager.acks.resolve(conn_id, 'p' + line[9:].strip())
+    elif tag == '__ACK__':
+        conn_manager.acks.resolve(conn_id, 'm' + line[8:].strip())
+    elif tag == '__FACK__':
+        parts = line.split()
+        if len(parts) == 3:
+            conn_manager.acks.resolve(conn_id, 'f' + parts[1], ok=parts[2] == 'ok')
+    else:
+        console.error(f'Unknown control message "{tag}"', peer)
+
+
+def ping(conn_id, conn_manager, count, cancel_event=None):
+    """Send count pings to conn_id, one at a time, and return a summary"""
+    conn_info = conn_manager.get_connection(conn_id)
+    if not conn_info:
+        return f'Error: No connection with id {conn_id}\n'
+    if 'ping' not in conn_info['peer_caps']:
+        return f'Error: Connection {conn_id} does not support ping\n'
+
+    rtts = []
+    sent = 0
+    for _ in range(count):
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        done = threading.Event()
+        result = {}
+
+        def on_done(rtt, ok, result=result, done=done):
+            result['rtt'] = rtt
+            done.set()
+
+        seq = conn_manager.acks.next_seq()
+        conn_manager.acks.register(conn_id, 'p' + seq, 'ping', PING_TIMEOUT, on_done)
+        if not conn_manager.send_control(conn_id, f'__PING__ {seq}\n'):
+            break
+        sent += 1
+        # bounded, so a cancel is noticed even if the tracker never calls back
+        while not done.wait(PING_TIMEOUT + 1):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+        if result.get('rtt') is not None:
+            rtts.append(result['rtt'])
+            time.sleep(PING_INTERVAL)
+        elif not conn_manager.get_connection(conn_id):
+            break  # connection closed
+    return f'PING connection {conn_id}: ' + summarize(rtts, sent) + '\n'
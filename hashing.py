@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+File checksums. Besides plain SHA-256, which every peer understands, files
+can be hashed with BLAKE2b and/or as a tree: the file is cut into LEAF_SIZE
+leaves that are hashed in parallel on a thread pool (hashlib releases the
+GIL), and the root digest is the hash of the leaf digests.
+
+In file headers the checksum field is "<algorithm>:<hex>"; bare hex means
+sha256, so peers from before this scheme keep working. Nodes list what they
+accept in their hello (hash=...), and a sender only uses an algorithm the
+receiver listed.
+"""
+
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from jobs import TransferCancelled
+
+ALGORITHMS = ('sha256', 'blake2b', 'sha256-tree', 'blake2b-tree')
+DEFAULT_ALGORITHM = 'sha256-tree'
+
+# Leaf size is part of the tree format: both sides must use the same one
+LEAF_SIZE = 4 * 1024 * 1024
+
+# Read size for the sequential (non-tree) algorithms
+READ_SIZE = 1024 * 1024
+
+_LEAF_PREFIX = b'\x00'
+_ROOT_PREFIX = b'\x01'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Received leaves queued or being hashed, across all incoming files: one per
+# hashing thread, so a receiver that outruns the pool waits (and stops
+# reading) instead of queueing leaves in memory
+_leaf_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+
+def _pool():
+    """Shared hashing pool, one thread per core"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                           thread_name_prefix='hash')
+        return _executor
+
+
+def _max_pending():
+    # leaves queued or being hashed at once; bounds memory to a few leaves per core
+    return 2 * (os.cpu_count() or 1)
+
+
+def _new_base(name):
+    if name == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.sha256()
+
+
+def _split(algorithm):
+    """'blake2b-tree' -> ('blake2b', True)"""
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"unknown checksum algorithm '{algorithm}' "
+                         f"(expected one of: {', '.join(ALGORITHMS)})")
+    name, _, tree = algorithm.partition('-')
+    return name, bool(tree)
+
+
+def _leaf(name, data):
+    h = _new_base(name)
+    h.update(_LEAF_PREFIX)
+    h.update(data)
+    return h.digest()
+
+
+def _leaf_at(name, fd, offset, size):
+    data = os.pread(fd, size, offset)
+    return _leaf(name, data)
+
+
+def _root(name, digests):
+    h = _new_base(name)
+    h.update(_ROOT_PREFIX)
+    for digest in digests:
+        h.update(digest)
+    return h.hexdigest()
+
+
+class TreeHasher:
+    """
+    hashlib-style hasher for the tree algorithms: update() collects leaves
+    and hands full ones to the pool, hexdigest() waits for them and combines.
+    Memory: the leaf being filled, plus the leaves in the shared slots.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.buf = bytearray()  # the leaf being filled
+        self.pending = deque()  # futures for leaves still being hashed
+        self.digests = []
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data):
+            # copies: callers reuse their receive buffers
+            take = min(len(data), LEAF_SIZE - len(self.buf))
+            self.buf += data[:take]
+            data = data[take:]
+            if len(self.buf) == LEAF_SIZE:
+                self._submit()
+
+    def _submit(self):
+        leaf, self.buf = self.buf, bytearray()
+        _leaf_slots.acquire()
+        try:
+            future = _pool().submit(_leaf, self.name, leaf)
+        except BaseException:
+            _leaf_slots.release()
+            raise
+        future.add_done_callback(lambda _future: _leaf_slots.release())
+        self.pending.append(future)
+        # keep only digests, not futures, for leaves already done
+        while self.pending and self.pending[0].done():
+            self.digests.append(self.pending.popleft().result())
+
+    def hexdigest(self):
+        # the last, partial leaf; an empty file is one empty leaf
+        if self.buf or not (self.pending or self.digests):
+            self._submit()
+        while self.pending:
+            self.digests.append(self.pending.popleft().result())
+        return _root(self.name, self.digests)
+
+
+def new_hasher(algorithm):
+    """Hasher with update()/hexdigest() for algorithm; ValueError if unknown"""
+    name, tree = _split(algorithm)
+    return TreeHasher(name) if tree else _new_base(name)
+
+
+def format_field(algorithm, hexdigest):
+    """Checksum field for a file header (bare hex for sha256)"""
+    return hexdigest if algorithm == 'sha256' else f'{algorithm}:{hexdigest}'
+
+
+def parse_field(field):
+    """Checksum field from a file header -> (algorithm, hex)"""
+    algorithm, sep, hexdigest = field.partition(':')
+    if not sep:
+        return 'sha256', field
+    return algorithm, hexdigest
+
+
+def choose(peer_hello, preferred):
+    """The algorithm to use for a peer: preferred if it accepts it, else sha256"""
+    accepted = peer_hello.get('hash', '').split(',')
+    return preferred if preferred in accepted else 'sha256'
+
+
+def file_checksum(path, algorithm, cancel_event=None):
+    """
+    Checksum field for the file at path. Tree algorithms read and hash the
+    leaves in parallel. Raises TransferCancelled if cancel_event is set.
+    """
+    name, tree = _split(algorithm)
+    with open(path, 'rb') as f:
+        if not tree:
+            h = _new_base(name)
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise TransferCancelled()
+                h.update(chunk)
+            return format_field(algorithm, h.hexdigest())
+
+        size = os.fstat(f.fileno()).st_size
+        pending = deque()
+        digests = []
+        try:
+            # range(0, 1) for an empty file: one empty leaf, as in TreeHasher
+            for offset in range(0, max(size, 1), LEAF_SIZE):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise TransferCancelled()
+                pending.append(_pool().submit(_leaf_at, name, f.fileno(), offset,
+                                              min(LEAF_SIZE, size - offset)))
+                while len(pending) > _max_pending():
+                    digests.append(pending.popleft().result())
+            while pending:
+                digests.append(pending.popleft().result())
+        finally:
+            # no leaf may still be reading when the file is closed
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled():
+                    future.exception()
+        return format_field(algorithm, _root(name, digests))
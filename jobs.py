@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Background jobs: slow commands (connect, sendfile) run on a worker pool so
+the console stays responsive, and can be listed, waited for or cancelled.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+DEFAULT_WORKERS = 8
+
+
+class TransferCancelled(Exception):
+    """
+    Raised inside a job that stopped because `cancel` was requested; the
+    message, if any, becomes the job's result
+    """
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:.0f}{unit}" if unit == 'B' else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+class Job:
+    def __init__(self, job_id: int, command: str):
+        self.id = job_id
+        self.command = command
+        self.status = 'queued'  # queued, running, done, failed, cancelled
+        self.result = ''
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+        self.future = None
+
+        # transfer progress, updated through progress()
+        self.bytes_done = 0
+        self.bytes_total = None
+        self.progress_started = None
+
+    def progress(self, bytes_done, bytes_total):
+        """Progress callback handed to long-running commands"""
+        if self.progress_started is None:
+            self.progress_started = time.monotonic()
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+
+    def describe(self):
+        """One line for `jobs`: id, status, command and transfer progress"""
+        line = f"{self.id}: {self.status:<9} {self.command}"
+        if self.bytes_total:
+            end = self.finished or time.monotonic()
+            elapsed = end - self.progress_started if self.progress_started else 0
+            rate = self.bytes_done / elapsed if elapsed > 0 else 0
+            line += (f"  {format_bytes(self.bytes_done)}/{format_bytes(self.bytes_total)}"
+                     f" ({100 * self.bytes_done / self.bytes_total:.0f}%)")
+            if rate:
+                line += f"  {format_bytes(rate)}/s"
+                if self.status == 'running':
+                    line += f"  ETA {(self.bytes_total - self.bytes_done) / rate:.0f}s"
+        elif self.status == 'running' and self.started:
+            line += f"  {time.monotonic() - self.started:.1f}s"
+        return line
+
+
+class JobManager:
+    """
+    Runs commands on a thread pool.
+    on_finish: called as on_finish(job) from the worker when a job ends
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, on_finish: Callable = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.jobs: Dict[int, Job] = {}
+        self.next_job_id = 1
+        self.lock = threading.Lock()
+        self.on_finish = on_finish
+
+    def submit(self, command: str, fn: Callable) -> Job:
+        """Run fn(job) in the background; its return value becomes job.result"""
+        with self.lock:
+            job = Job(self.next_job_id, command)
+            self.next_job_id += 1
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'
+        else:
+            job.status = 'running'
+            job.started = time.monotonic()
+            try:
+                # a job that ignored a late cancel still finished normally
+                job.result = fn(job) or ''
+                job.status = 'failed' if job.result.startswith('Error') else 'done'
+            except TransferCancelled as e:
+                job.result = str(e)
+                job.status = 'cancelled'
+            except Exception as e:
+                job.result = f"Error: {e}"
+                job.status = 'failed'
+        job.finished = time.monotonic()
+        job.done_event.set()
+        if self.on_finish is not None:
+            self.on_finish(job)
+
+    def get(self, job_id) -> Job:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_all(self) -> Dict[int, Job]:
+        with self.lock:
+            return self.jobs.copy()
+
+    def cancel(self, job_id) -> bool:
+        """Request cancellation; queued jobs never start, running ones stop at their next check"""
+        job = self.get(job_id)
+        if job is None or job.done_event.is_set():
+            return False
+        job.cancel_event.set()
+        return True
+
+    def prune(self, keep=100):
+        """Forget the oldest finished jobs beyond `keep`"""
+        with self.lock:
+            finished = [j for j in self.jobs.values() if j.done_event.is_set()]
+            for job in finished[:max(0, len(finished) - keep)]:
+                del self.jobs[job.id]
+
+    def shutdown(self):
+        for job in self.get_all().values():
+            job.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Same-host fast path: every node also listens on a Unix domain socket named
+after its TCP port, and connect() uses it when the destination is this
+machine. Over that socket sendfile passes the open file descriptor itself
+(SCM_RIGHTS) instead of streaming the bytes through the socket.
+
+The sockets live in a directory only this user can enter, and both ends
+check the other's uid where the platform reports it, so a socket path
+cannot be squatted by another user to intercept connects.
+"""
+
+import os
+import socket
+import stat
+import struct
+import tempfile
+
+SUPPORTED = hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+# Most descriptors accepted with one recv
+MAX_FDS = 4
+
+
+def socket_dir():
+    """
+    This user's socket directory ($XDG_RUNTIME_DIR/p2pchat, else a per-uid
+    directory in the temp dir), created 0700. Raises OSError if it exists
+    but is not a private directory owned by us.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        path = os.path.join(runtime, 'p2pchat')
+    else:
+        path = os.path.join(tempfile.gettempdir(), f'p2pchat-{os.getuid()}')
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise OSError(f'{path} is not a private directory owned by this user')
+    return path
+
+
+def socket_path(port):
+    """Path of the Unix socket belonging to this user's node listening on port"""
+    return os.path.join(socket_dir(), f'{port}.sock')
+
+
+def peer_uid(sock):
+    """uid of the process at the other end of a Unix socket, or None if unknown"""
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+    if hasattr(os, 'getpeereid'):
+        return os.getpeereid(sock.fileno())[1]
+    return None
+
+
+def same_user(sock):
+    """False if the peer is known to run as another user"""
+    uid = peer_uid(sock)
+    return uid is None or uid == os.getuid()
+
+
+def is_local_address(ip, my_ip=None):
+    """True if ip is a loopback address or one of this host's own addresses"""
+    if ip.startswith('127.') or ip == my_ip:
+        return True
+    try:
+        return ip in socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        return False
+
+
+def listen(port, backlog=5):
+    """
+    Create the Unix listening socket for port, replacing a stale socket file
+    left behind by a node that exited without cleaning up. Returns None if
+    the platform has no Unix sockets; raises OSError if the path is owned by
+    a live process or the socket directory is not private.
+    """
+    if not SUPPORTED:
+        return None
+    path = socket_path(port)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise OSError(f'{path} is already in use by another process')
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def close_listener(sock, port):
+    """Close a socket from listen() and remove its file"""
+    try:
+        sock.close()
+    finally:
+        try:
+            os.unlink(socket_path(port))
+        except OSError:
+            pass
+
+
+def connect(port, timeout=5.0):
+    """
+    Connect to this user's node listening on port over its Unix socket, or
+    return None (caller falls back to TCP)
+    """
+    if not SUPPORTED:
+        return None
+    try:
+        path = socket_path(port)
+    except OSError:
+        return None
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        if not same_user(sock):
+            raise OSError('socket owned by another user')
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def is_unix(sock):
+    return SUPPORTED and sock.family == socket.AF_UNIX
+
+
+def recv(sock, bufsize, fds):
+    """recv() that also collects descriptors passed with the data into fds"""
+    if not is_unix(sock):
+        return sock.recv(bufsize)
+    data, received, _flags, _addr = socket.recv_fds(sock, bufsize, MAX_FDS)
+    fds.extend(received)
+    return data
+
+
+def copy_from_fd(fd, size, out_file, hasher, chunk_size=1024 * 1024):
+    """
+    Copy size bytes from the start of a passed descriptor into out_file,
+    updating hasher. pread() keeps us independent of the sender's offset.
+    Returns the number of bytes copied (less than size if the file shrank).
+    """
+    offset = 0
+    while offset < size:
+        chunk = os.pread(fd, min(chunk_size, size - offset), offset)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        out_file.write(chunk)
+        offset += len(chunk)
+    return offset
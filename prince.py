@@ -1,6 +1,16 @@
 import socket
 import os
-import hashlib
+import itertools
+import ssl
+from tls_transport import wrap_client_socket, describe, TLS_RECORD_SIZE
+import local_transport
+from jobs import TransferCancelled
+import control
+import udp_channel
+import hashing
+
+# Bytes read from disk per step when streaming a file
+FILE_CHUNK_SIZE = 4 * TLS_RECORD_SIZE
 
 def is_valid_ip(ip):
     """Validate IP address format (IPv4)"""
@@ -38,10 +48,20 @@ Available commands:
   terminate <connection_id>    - Close the connection with the specified ID
   send <connection_id> <msg>   - Send a message (up to 100 chars) to the specified connection
   sendfile <connection_id> <filepath> - Send a file to the specified connection
+  ratelimit [<connection_id>|all <rate>|off [send|recv|both]]
+                               - Show or set bandwidth limits, e.g. ratelimit 1 10MB/s
+  log [normal|quiet|json]      - Show or set how incoming messages and events are printed
+  ping <connection_id> [count] - Measure round-trip time (min/avg/p99)
+  receipts [on|off]            - Show or set whether delivery confirmations are printed
+  hash [algorithm]             - Show or set the checksum algorithm for sent files
+  jobs                         - List background jobs (connect, sendfile, ping) with progress
+  wait <job_id>                - Wait for a background job and show its result
+  cancel <job_id>              - Cancel a background job
   exit                         - Close all connections and terminate the program
 """)
 
-def connect(destination, port, conn_manager, my_ip=None, my_port=None):
+def connect(destination, port, conn_manager, my_ip=None, my_port=None, tls_context=None,
+            local_fast_path=True, plain_local=False, cancel_event=None):
     """
     Establish a TCP connection to the specified IP and port
     destination: IP address to connect to
@@ -49,6 +69,15 @@ def connect(destination, port, conn_manager, my_ip=None, my_port=None):
     conn_manager: ConnectionManager instance
     my_ip: current machine's IP (for self-connection check)
     my_port: current machine's port (for self-connection check)
+    tls_context: client ssl.SSLContext; when given the connection is wrapped
+                 in TLS, resuming a cached session for this peer if possible
+    local_fast_path: if destination is this host and the node there has a
+                     Unix socket, use it instead of TCP (the traffic never
+                     leaves the host)
+    plain_local: allow that Unix socket, which is unencrypted, even when
+                 tls_context is given
+    cancel_event: optional threading.Event; if set by the time the connection
+                  is up, it is closed again and TransferCancelled is raised
     """
     # Validate IP address format
     if not is_valid_ip(destination):
@@ -71,19 +100,41 @@ def connect(destination, port, conn_manager, my_ip=None, my_port=None):
         return f"Error: Already connected to {destination}:{port_num}\n"
     
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5.0)  # 5 second timeout for better reliability
-        sock.connect((destination, port_num))        
+        sock = None
+        use_local = local_fast_path and (tls_context is None or plain_local)
+        if use_local and local_transport.is_local_address(destination, my_ip):
+            sock = local_transport.connect(port_num)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(5.0)  # 5 second timeout for better reliability
+            sock.connect((destination, port_num))
+        if tls_context is not None and not local_transport.is_unix(sock):
+            try:
+                sock = wrap_client_socket(sock, tls_context, destination, port_num)
+            except ssl.SSLError as e:
+                sock.close()
+                return f"Error: TLS handshake with {destination}:{port_num} failed - {e}\n"
+        if cancel_event is not None and cancel_event.is_set():
+            sock.close()
+            raise TransferCancelled(f"Connect to {destination}:{port_num} cancelled\n")
+        
         # Add to connection manager
         conn_id = conn_manager.add_connection(sock, destination, port_num)
         
         # Start receiver thread for this connection
         from Sultan import start_receiver_thread
         thread = start_receiver_thread(sock, destination, port_num, 
-                                     lambda conn_id: conn_manager.remove_connection(conn_id), conn_id)
+                                     lambda conn_id: conn_manager.remove_connection(conn_id), conn_id,
+                                     conn_manager)
         conn_manager.set_receiver_thread(conn_id, thread)
         
-        return f"✓ Connected to {destination} on port {port_num} (Connection ID: {conn_id})\n"
+        if local_transport.is_unix(sock):
+            transport = " over local socket"
+        elif tls_context is not None:
+            transport = f" over {describe(sock)}"
+        else:
+            transport = ''
+        return f"✓ Connected to {destination} on port {port_num} (Connection ID: {conn_id}){transport}\n"
     except socket.timeout:
         return f"Error: Connection timeout to {destination}:{port_num}\n"
     except ConnectionRefusedError:
@@ -101,7 +152,12 @@ def list(connections_dict):
     
     connectionslist = "id: IP address: \t Port No.\n"
     for conn_id, conn_info in connections_dict.items():
-        connectionslist += f"{conn_id}: {conn_info['ip']} \t {conn_info['port']}\n"
+        local = " \t (local)" if local_transport.is_unix(conn_info['sock']) else ''
+        if udp_channel.usable(conn_info):
+            local += " \t (udp)"
+        rtt = conn_info['rtt'].describe() if 'rtt' in conn_info else ''
+        rtt = f" \t {rtt}" if rtt else ''
+        connectionslist += f"{conn_id}: {conn_info['ip']} \t {conn_info['port']}{local}{rtt}\n"
     return connectionslist
 
 def terminate(connection_id, connections_dict):
@@ -128,12 +184,27 @@ def terminate(connection_id, connections_dict):
     except ValueError:
         return "Error: Connection ID must be an integer\n"
 
-def sendfile(connection_id, filepath, conn_manager):
+def _file_chunks(f, file_size, progress=None, cancel_event=None):
+    """Read f in FILE_CHUNK_SIZE pieces, reporting progress and honouring cancellation"""
+    done = 0
+    for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+        if cancel_event is not None and cancel_event.is_set():
+            raise TransferCancelled()
+        yield chunk
+        done += len(chunk)
+        if progress is not None:
+            progress(done, file_size)
+
+def sendfile(connection_id, filepath, conn_manager, progress=None, cancel_event=None):
     """
     Send a file to the specified connection
     connection_id: ID of the connection to send to
     filepath: path to the file to send
     conn_manager: ConnectionManager instance
+    progress: optional callback progress(bytes_sent, file_size)
+    cancel_event: optional threading.Event; when set the transfer stops and,
+                  if data was already on the wire, the connection is closed
+                  so the receiver discards the partial file
     """
     # Validate connection ID
     try:
@@ -158,24 +229,52 @@ def sendfile(connection_id, filepath, conn_manager):
         file_size = os.path.getsize(filepath)
         filename = os.path.basename(filepath)
         
-        # Read file data and calculate checksum
-        with open(filepath, 'rb') as f:
-            file_data = f.read()
+        # Checksum for integrity verification: our preferred algorithm if
+        # the receiver accepts it, plain SHA-256 otherwise
+        algorithm = hashing.choose(conn_info['peer_hello'], conn_manager.hash_algorithm)
+        checksum = hashing.file_checksum(filepath, algorithm, cancel_event)
         
-        # Calculate SHA256 checksum for integrity verification
-        checksum = hashlib.sha256(file_data).hexdigest()
+        # Receivers that support acks confirm the checksum once the file is in;
+        # registered up front since the ack can beat the end of send_iter, but
+        # without a deadline: the timeout starts once the transfer is done
+        acked = 'ack' in conn_info['peer_caps']
+        if acked:
+            conn_manager.acks.register(conn_id, 'f' + checksum, f"File '{filename}'",
+                                       None, rtt_sample=False)
         
-        sock = conn_info['sock']
+        # Same host: hand the receiver our descriptor instead of the bytes
+        if local_transport.is_unix(conn_info['sock']):
+            header = f"__FILEFD__ {filename} {file_size} {checksum}\n"
+            with open(filepath, 'rb') as f:
+                conn_info['writer'].send_fds(header.encode('utf-8'), [f.fileno()])
+            if progress is not None:
+                progress(file_size, file_size)
+            if acked:
+                conn_manager.acks.rearm(conn_id, 'f' + checksum, control.FILE_ACK_TIMEOUT)
+            return f"File '{filename}' ({file_size} bytes) sent to connection {conn_id}\n"
         
         # Send file header: __FILE__ <filename> <size> <checksum>\n
         header = f"__FILE__ {filename} {file_size} {checksum}\n"
-        sock.sendall(header.encode('utf-8'))
         
-        # Send file data
-        sock.sendall(file_data)
+        # Stream header and file data as one run of record-sized writes, so
+        # the header shares a record with the start of the payload and the
+        # whole file never has to sit in memory
+        with open(filepath, 'rb') as f:
+            chunks = _file_chunks(f, file_size, progress, cancel_event)
+            try:
+                conn_info['writer'].send_iter(itertools.chain([header.encode('utf-8')], chunks))
+            except TransferCancelled:
+                conn_manager.remove_connection(conn_id)
+                raise TransferCancelled(f"Transfer of '{filename}' cancelled; connection {conn_id} closed "
+                                        f"so the receiver discards the partial file\n")
         
+        if acked:
+            # time the receiver's verification from the end of the transfer
+            conn_manager.acks.rearm(conn_id, 'f' + checksum, control.FILE_ACK_TIMEOUT)
         return f"File '{filename}' ({file_size} bytes) sent to connection {conn_id}\n"
         
+    except TransferCancelled as e:
+        raise TransferCancelled(str(e) or f"Transfer of '{filename}' cancelled before sending\n")
     except PermissionError:
         return f"Error: Permission denied reading file '{filepath}'\n"
     except OSError as e:
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Bandwidth shaping: token buckets for per-connection and global send/receive
+limits, and a fair scheduler that hands out send budget across connections.
+"""
+
+import re
+import threading
+import time
+from collections import deque
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+_RATE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?(?:/S)?$')
+
+# Smallest burst a bucket allows, so one TLS record always fits
+MIN_BURST = 16384
+
+
+def parse_rate(text):
+    """
+    Parse a rate such as "10MB/s", "512K" or "2000" (bytes per second).
+    Returns bytes per second, or None for "off"/"none"/"0" (unlimited).
+    Raises ValueError for anything else.
+    """
+    normalized = text.strip().upper()
+    if normalized in ('OFF', 'NONE', 'UNLIMITED'):
+        return None
+    match = _RATE_RE.match(normalized)
+    if not match:
+        raise ValueError(f"invalid rate '{text}' (expected e.g. 10MB/s, 512KB/s, off)")
+    rate = float(match.group(1)) * _UNITS[match.group(2)]
+    return rate if rate > 0 else None
+
+
+def parse_size(text):
+    """Parse a byte count such as "64MB", "256K" or "8192" """
+    size = parse_rate(text)
+    if size is None or '/' in text:
+        raise ValueError(f"invalid size '{text}' (expected e.g. 64MB, 256KB)")
+    return int(size)
+
+
+def format_rate(rate):
+    """Inverse of parse_rate, for display"""
+    if rate is None:
+        return 'unlimited'
+    for unit in ('G', 'M', 'K'):
+        if rate >= _UNITS[unit]:
+            return f"{rate / _UNITS[unit]:g}{unit}B/s"
+    return f"{rate:g}B/s"
+
+
+class TokenBucket:
+    """
+    Token bucket measured in bytes. A caller may take more tokens than are
+    available (the bucket goes into debt) so large writes never deadlock;
+    the debt is paid back before anyone else is allowed through.
+    """
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the rate in bytes/s; None removes the limit"""
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.burst = max(rate / 20, MIN_BURST) if rate else 0
+            self.tokens = min(self.tokens, self.burst)
+
+    @property
+    def limited(self):
+        return self.rate is not None
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self):
+        """Seconds until the bucket can admit another write (0 if now)"""
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            return 0.0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def take(self, nbytes):
+        """Remove nbytes of tokens without waiting"""
+        with self.lock:
+            if self.rate is None:
+                return
+            self._refill()
+            self.tokens -= nbytes
+
+    def throttle(self, nbytes):
+        """Take nbytes and return how long the caller should pause afterwards"""
+        self.take(nbytes)
+        return self.delay()
+
+
+class FairScheduler:
+    """
+    Fair queuing of send budget. Every record a connection wants to send asks
+    for a grant; grants are handed out round robin across connections, so N
+    concurrent transfers each get ~1/N of the global rate no matter how many
+    chunks each has queued. Interactive (chat) writes skip the queue and are
+    only charged, which keeps them low latency behind bulk transfers.
+    """
+
+    def __init__(self, global_bucket: TokenBucket):
+        self.global_bucket = global_bucket
+        self.cond = threading.Condition()
+        # conn_id -> number of senders waiting on that connection
+        self.waiting = {}
+        # round-robin order of connections that have a sender waiting
+        self.ring = deque()
+
+    def acquire(self, conn_id, nbytes, conn_bucket: TokenBucket, interactive=False):
+        """Block until conn_id may send nbytes, then charge the buckets"""
+        if interactive or not (self.global_bucket.limited or conn_bucket.limited):
+            conn_bucket.take(nbytes)
+            self.global_bucket.take(nbytes)
+            return
+
+        with self.cond:
+            self.waiting[conn_id] = self.waiting.get(conn_id, 0) + 1
+            if self.waiting[conn_id] == 1:
+                self.ring.append(conn_id)
+            try:
+                while True:
+                    if self.ring[0] == conn_id:
+                        conn_delay = conn_bucket.delay()
+                        if conn_delay > 0 and len(self.ring) > 1:
+                            # Our own limit holds us back; let the next
+                            # connection use the global budget meanwhile
+                            self.ring.rotate(-1)
+                            self.cond.notify_all()
+                            self.cond.wait(conn_delay)
+                            continue
+                        wait = max(conn_delay, self.global_bucket.delay())
+                        if wait <= 0:
+                            conn_bucket.take(nbytes)
+                            self.global_bucket.take(nbytes)
+                            return
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait(1.0)
+            finally:
+                self.waiting[conn_id] -= 1
+                # Move to the back of the ring: one grant per turn
+                self.ring.remove(conn_id)
+                if self.waiting[conn_id]:
+                    self.ring.append(conn_id)
+                else:
+                    del self.waiting[conn_id]
+                self.cond.notify_all()
+
+
+def ratelimit_command(args, conn_manager):
+    """
+    Handle `ratelimit [<connection_id>|all <rate>|off [send|recv|both]]`
+    args: command arguments after the command name
+    conn_manager: ConnectionManager instance
+    """
+    if not args:
+        lines = [f"global: send {format_rate(conn_manager.global_send_bucket.rate)}, "
+                 f"recv {format_rate(conn_manager.global_recv_bucket.rate)}"]
+        for conn_id, conn_info in sorted(conn_manager.get_all_connections().items()):
+            lines.append(f"{conn_id}: send {format_rate(conn_info['send_bucket'].rate)}, "
+                         f"recv {format_rate(conn_info['recv_bucket'].rate)}")
+        return '\n'.join(lines) + '\n'
+
+    if len(args) not in (2, 3):
+        return "Usage: ratelimit <connection_id|all> <rate|off> [send|recv|both]\n"
+
+    direction = args[2].lower() if len(args) == 3 else 'both'
+    if direction not in ('send', 'recv', 'both'):
+        return "Error: direction must be send, recv or both\n"
+
+    try:
+        rate = parse_rate(args[1])
+    except ValueError as e:
+        return f"Error: {e}\n"
+
+    if args[0].lower() == 'all':
+        conn_id = None
+        target = 'global'
+    else:
+        try:
+            conn_id = int(args[0])
+        except ValueError:
+            return "Error: Connection ID must be an integer or 'all'\n"
+        target = f"connection {conn_id}"
+
+    if not conn_manager.set_rate_limit(conn_id, direction, rate):
+        return f"Error: No connection with id {conn_id}\n"
+    return f"Rate limit for {target} ({direction}) set to {format_rate(rate)}\n"
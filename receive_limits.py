@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Receive-side memory budgets: caps on how much unprocessed data one
+connection and the whole node may hold, and on header/message line length.
+"""
+
+import threading
+
+# Largest single recv() a receiver thread issues
+RECV_SIZE = 65536
+MIN_RECV_SIZE = 4096
+
+DEFAULT_MAX_LINE_LEN = 8 * 1024
+DEFAULT_CONN_LIMIT = 256 * 1024
+DEFAULT_GLOBAL_LIMIT = 64 * 1024 * 1024
+
+# A connection holding a partial line that cannot get budget for this long
+# is closed; idle connections just keep waiting
+STALL_TIMEOUT = 30.0
+
+
+class LineTooLong(Exception):
+    """A peer sent more than max_line_len bytes without a newline"""
+
+
+class ReceiveBudget:
+    """
+    Counts bytes that receiver threads have read (or are about to read) but
+    not yet consumed. Threads reserve budget before every recv(); when the
+    global budget is exhausted reserve() blocks, the socket is not read and
+    TCP flow control pushes back on the sender.
+    """
+
+    def __init__(self, global_limit=DEFAULT_GLOBAL_LIMIT, conn_limit=DEFAULT_CONN_LIMIT,
+                 max_line_len=DEFAULT_MAX_LINE_LEN):
+        if max_line_len >= conn_limit:
+            raise ValueError('per-connection buffer must be larger than the maximum line length')
+        if conn_limit > global_limit:
+            raise ValueError('per-connection buffer cannot exceed the global receive budget')
+        self.global_limit = global_limit
+        self.conn_limit = conn_limit
+        self.max_line_len = max_line_len
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def reserve(self, nbytes, timeout=None) -> int:
+        """
+        Reserve up to nbytes of global budget, settling for as little as
+        MIN_RECV_SIZE when memory is tight. Returns the amount granted, or 0
+        if not even that freed up within timeout.
+        """
+        minimum = min(nbytes, MIN_RECV_SIZE)
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.used + minimum <= self.global_limit, timeout):
+                return 0
+            granted = min(nbytes, self.global_limit - self.used)
+            self.used += granted
+            return granted
+
+    def release(self, nbytes):
+        """Return budget reserved with reserve()"""
+        if nbytes <= 0:
+            return
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+    def recv_size(self, buffered) -> int:
+        """How much a connection already holding `buffered` bytes may read next"""
+        return max(0, min(RECV_SIZE, self.conn_limit - buffered))
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Swarm soak test: starts a real node on loopback and hammers it with a swarm
+of lightweight simulated peers (one non-blocking socket each, all driven
+from a single event loop), while sampling the node's RSS, thread count,
+open descriptors and delivery latency.
+
+Usage:
+    python3 swarm.py --peers 2000 --duration 600 --churn 20 --msg-rate 5000 \\
+        --files 4 --file-size 4MB --csv swarm.csv
+
+Latency is measured end to end: every message carries its send time and the
+node runs with --log-mode json, so the time it logs the message minus the
+send time is the delivery latency (same host, same clock). Connection
+latency is the time from connect() to the node logging the new connection.
+Process metrics come from /proc (Linux); on other systems they are blank.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import resource
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+from rate_limiter import parse_size
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples, pct):
+    """pct-th percentile of an already sorted list (None if empty)"""
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+def raise_fd_limit(needed):
+    """Lift the soft descriptor limit (inherited by the node) as far as allowed"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else max(soft, needed)
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        soft = target
+    if soft < needed:
+        print(f'Warning: descriptor limit {soft} is below the {needed} this run needs')
+
+
+def process_stats(pid):
+    """(rss_kb, threads, fds) of a process, or Nones where /proc is unavailable"""
+    rss = threads = fds = None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+        fds = len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        pass
+    return rss, threads, fds
+
+
+class Peer:
+    """One simulated peer: a non-blocking socket and a queue of pending writes"""
+
+    def __init__(self, sock, started):
+        self.sock = sock
+        self.started = started
+        self.connected = False
+        self.local_port = None
+        self.out = deque()  # [memoryview, is_file] still to send, in order
+        self.sending_file = False
+
+
+class Swarm:
+    def __init__(self, args):
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.peers = set()
+        self.lock = threading.Lock()
+
+        # samples collected since the last report, guarded by lock
+        self.latencies = []
+        self.connect_latencies = []
+        self.connect_started = {}  # local port -> connect() time
+        self.files_verified = 0
+        self.files_failed = 0
+
+        # counters since the start
+        self.messages_sent = 0
+        self.file_bytes_sent = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.errors = 0
+
+        self.payload = os.urandom(args.file_size) if args.files else b''
+        self.payload_checksum = hashlib.sha256(self.payload).hexdigest()
+        self.node = None
+        self.workdir = None
+
+    # --- node process -----------------------------------------------------
+
+    def start_node(self):
+        """Start the node under test and a thread that parses its JSON log"""
+        self.workdir = tempfile.mkdtemp(prefix='swarm-')
+        cmd = [sys.executable, os.path.join(HERE, 'chat.py'), str(self.args.port),
+               '--log-mode', 'json', '--flood-threshold', '0', '--no-local']
+        self.node = subprocess.Popen(cmd, cwd=self.workdir, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     text=True, bufsize=1)
+        threading.Thread(target=self._read_node_log, daemon=True).start()
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.args.port), timeout=1).close()
+                return
+            except OSError:
+                if self.node.poll() is not None:
+                    break
+                time.sleep(0.1)
+        raise RuntimeError(f'node did not start listening on port {self.args.port}')
+
+    def stop_node(self):
+        if self.node is None:
+            return
+        try:
+            self.node.stdin.write('exit\n')
+            self.node.stdin.flush()
+            self.node.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.node.kill()
+
+    def _read_node_log(self):
+        for line in self.node.stdout:
+            try:
+                # log lines can follow the node's "> " input prompt
+                record = json.loads(line.lstrip('> '))
+            except ValueError:
+                continue  # command output, not a log record
+            kind, text = record.get('kind'), record.get('text', '')
+            with self.lock:
+                if kind == 'message' and text.startswith('swarm '):
+                    try:
+                        self.latencies.append(record['ts'] - float(text.split()[1]))
+                    except (IndexError, ValueError):
+                        pass
+                elif text.startswith('✓ Connection established') and 'peer' in record:
+                    port = int(record['peer'].rsplit(':', 1)[1])
+                    started = self.connect_started.pop(port, None)
+                    if started is not None:
+                        self.connect_latencies.append(record['ts'] - started)
+                elif 'File "swarm-' in text:
+                    if 'received successfully' in text:
+                        self.files_verified += 1
+                    elif 'corrupted' in text:
+                        self.files_failed += 1
+
+    # --- peers ------------------------------------------------------------
+
+    def open_peer(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        started = time.time()
+        try:
+            sock.connect_ex(('127.0.0.1', self.args.port))
+        except OSError:
+            sock.close()
+            self.errors += 1
+            return
+        peer = Peer(sock, started)
+        self.peers.add(peer)
+        self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, peer)
+
+    def close_peer(self, peer):
+        self.peers.discard(peer)
+        try:
+            self.selector.unregister(peer.sock)
+        except (KeyError, ValueError):
+            pass
+        peer.sock.close()
+        self.disconnects += 1
+
+    def queue(self, peer, data, is_file=False):
+        peer.out.append([memoryview(data), is_file])
+        self._want_write(peer, True)
+
+    def _want_write(self, peer, want):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want else 0)
+        try:
+            self.selector.modify(peer.sock, events, peer)
+        except (KeyError, ValueError):
+            pass
+
+    def _on_event(self, peer, mask):
+        if not peer.connected:
+            err = peer.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.errors += 1
+                self.close_peer(peer)
+                return
+            peer.connected = True
+            peer.local_port = peer.sock.getsockname()[1]
+            with self.lock:
+                self.connect_started[peer.local_port] = peer.started
+            self.connects += 1
+            self._want_write(peer, bool(peer.out))
+
+        if mask & selectors.EVENT_READ:
+            try:
+                if not peer.sock.recv(65536):
+                    self.close_peer(peer)  # node closed us
+                    return
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.errors += 1
+                self.close_peer(peer)
+                return
+
+        if mask & selectors.EVENT_WRITE:
+            while peer.out:
+                head, is_file = peer.out[0]
+                try:
+                    sent = peer.sock.send(head)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    self.errors += 1
+                    self.close_peer(peer)
+                    return
+                if is_file:
+                    self.file_bytes_sent += sent
+                if sent < len(head):
+                    peer.out[0][0] = head[sent:]
+                    break
+                peer.out.popleft()
+                if not peer.out:
+                    peer.sending_file = False
+            self._want_write(peer, bool(peer.out))
+
+    def send_message(self, peer):
+        self.queue(peer, f'swarm {time.time():.6f}\n'.encode())
+        self.messages_sent += 1
+
+    def send_file(self, peer, n):
+        # reuse a small set of names so the node's disk use stays bounded
+        name = f'swarm-{n % (2 * self.args.files)}.bin'
+        header = f'__FILE__ {name} {len(self.payload)} {self.payload_checksum}\n'
+        peer.sending_file = True
+        self.queue(peer, header.encode())
+        self.queue(peer, self.payload, is_file=True)
+
+    # --- main loop --------------------------------------------------------
+
+    def run(self):
+        args = self.args
+        raise_fd_limit(args.peers * 2 + 256)
+        self.start_node()
+        print(f'Node pid {self.node.pid} listening on {args.port}, work dir {self.workdir}')
+
+        writer = None
+        csv_file = None
+        if args.csv:
+            csv_file = open(args.csv, 'w', newline='')
+            writer = csv.writer(csv_file)
+            writer.writerow(['elapsed_s', 'peers', 'messages_sent', 'file_bytes_sent',
+                             'rss_kb', 'threads', 'fds', 'msg_p50_ms', 'msg_p90_ms', 'msg_p99_ms',
+                             'msg_max_ms', 'connect_p50_ms', 'connect_p99_ms',
+                             'files_verified', 'files_failed', 'errors'])
+
+        start = time.monotonic()
+        next_report = start + args.interval
+        last_tick = start
+        msg_credit = churn_credit = 0.0
+        file_count = 0
+
+        try:
+            # ramp up
+            for _ in range(args.peers):
+                self.open_peer()
+                if len(self.peers) % 200 == 0:
+                    self._poll(0)
+
+            while time.monotonic() - start < args.duration:
+                if self.node.poll() is not None:
+                    print(f'Node exited with status {self.node.returncode}')
+                    break
+                self._poll(0.01)
+
+                now = time.monotonic()
+                elapsed, last_tick = now - last_tick, now
+                connected = [p for p in self.peers if p.connected]
+
+                # re-dial peers that failed or were dropped by the node
+                for _ in range(min(args.peers - len(self.peers), 100)):
+                    self.open_peer()
+
+                # connection churn: drop some peers and dial replacements
+                churn_credit += args.churn * elapsed
+                while churn_credit >= 1 and connected:
+                    churn_credit -= 1
+                    victim = random.choice(connected)
+                    # a peer with queued output is skipped, not replaced
+                    if not victim.out:
+                        self.close_peer(victim)
+                        connected.remove(victim)
+                        self.open_peer()
+
+                # message flood from random idle peers
+                msg_credit += args.msg_rate * elapsed
+                idle = [p for p in connected if not p.sending_file]
+                while msg_credit >= 1 and idle:
+                    msg_credit -= 1
+                    self.send_message(random.choice(idle))
+
+                # keep the requested number of file transfers in flight
+                busy = sum(1 for p in connected if p.sending_file)
+                for peer in random.sample(idle, min(len(idle), max(0, args.files - busy))):
+                    self.send_file(peer, file_count)
+                    file_count += 1
+
+                if now >= next_report:
+                    next_report += args.interval
+                    self._report(now - start, writer)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if time.monotonic() > next_report - args.interval + 0.5:
+                self._report(time.monotonic() - start, writer)
+            for peer in list(self.peers):
+                self.close_peer(peer)
+            self.stop_node()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            if csv_file:
+                csv_file.close()
+
+    def _poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            if key.data in self.peers:
+                self._on_event(key.data, mask)
+
+    def _report(self, elapsed, writer):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            connect = sorted(self.connect_latencies)
+            self.latencies = []
+            self.connect_latencies = []
+            verified, failed = self.files_verified, self.files_failed
+        rss, threads, fds = process_stats(self.node.pid)
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+
+        row = [round(elapsed, 1), len(self.peers), self.messages_sent, self.file_bytes_sent,
+               rss, threads, fds, ms(percentile(latencies, 50)), ms(percentile(latencies, 90)),
+               ms(percentile(latencies, 99)), ms(latencies[-1] if latencies else None),
+               ms(percentile(connect, 50)), ms(percentile(connect, 99)), verified, failed, self.errors]
+        if writer:
+            writer.writerow(row)
+        print(f'[{row[0]:>7}s] peers={row[1]} msgs={row[2]} file_MB={row[3] / 1e6:.1f} '
+              f'rss_kb={rss} threads={threads} fds={fds} '
+              f'msg_ms p50/p99/max={row[7]}/{row[9]}/{row[10]} connect_ms p50/p99={row[11]}/{row[12]} '
+              f'files ok/bad={verified}/{failed} errors={self.errors}', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak-test a node with a swarm of simulated peers')
+    parser.add_argument('--port', type=int, default=47999, help='port for the node under test')
+    parser.add_argument('--peers', type=int, default=1000, help='concurrent simulated peers')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--churn', type=float, default=10, help='peers replaced per second')
+    parser.add_argument('--msg-rate', type=float, default=1000, help='chat messages per second, total')
+    parser.add_argument('--files', type=int, default=0, help='file transfers kept in flight')
+    parser.add_argument('--file-size', type=parse_size, default=1024 * 1024, help='size of each file, e.g. 4MB')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between samples')
+    parser.add_argument('--csv', help='write samples to this CSV file')
+    Swarm(parser.parse_args()).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+TLS transport helpers: SSL contexts, client session reuse and record-sized
+write coalescing for connection sockets.
+"""
+
+import socket
+import ssl
+import threading
+from collections import deque
+
+# Largest TLS plaintext record; writes are grouped into chunks of this size
+TLS_RECORD_SIZE = 16384
+HANDSHAKE_TIMEOUT = 5.0
+
+# (host, port) -> ssl.SSLSession from the last successful client connection
+_session_cache = {}
+_session_lock = threading.Lock()
+
+
+def make_server_context(certfile, keyfile):
+    """Create the context used to wrap accepted connections"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # Issue a ticket per handshake so clients can resume instead of redoing
+    # the full key exchange on reconnect
+    context.num_tickets = 2
+    return context
+
+
+def make_client_context(cafile):
+    """
+    Create the context used by connect().
+    cafile: certificate(s) to trust; for loopback testing this can be the
+            same self-signed certificate the server loads
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_verify_locations(cafile)
+    # Peers are addressed by IP, not hostname; the chain is still verified
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def wrap_server_socket(conn, context):
+    """
+    Wrap an accepted socket without handshaking yet, so the accept loop
+    never waits on a slow client; call server_handshake() on the
+    connection's own thread.
+    """
+    conn.settimeout(HANDSHAKE_TIMEOUT)
+    return context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+
+
+def server_handshake(sock):
+    """Run the server side of the handshake (bounded by HANDSHAKE_TIMEOUT)"""
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    sock.do_handshake()
+
+
+def wrap_client_socket(sock, context, host, port):
+    """Run the client side of the handshake, resuming a cached session if any"""
+    with _session_lock:
+        session = _session_cache.get((host, port))
+    try:
+        tls_sock = context.wrap_socket(sock, server_hostname=host, session=session)
+    except ssl.SSLError:
+        # Possibly a stale ticket; make the next attempt do a full handshake
+        forget_session(host, port)
+        raise
+    remember_session(tls_sock, host, port)
+    return tls_sock
+
+
+def remember_session(sock, host, port):
+    """
+    Cache the session of a client-side TLS socket for later reuse.
+    Returns True if a resumable session was stored. With TLS 1.3 the ticket
+    only arrives after the handshake, so callers retry once data has flowed.
+    """
+    if not isinstance(sock, ssl.SSLSocket) or sock.server_side:
+        return False
+    try:
+        session = sock.session
+    except (ValueError, OSError):
+        return False
+    if session is None or (not session.has_ticket and not session.id):
+        return False
+    with _session_lock:
+        _session_cache[(host, port)] = session
+    return True
+
+
+def forget_session(host, port):
+    """Drop any cached session for host:port"""
+    with _session_lock:
+        _session_cache.pop((host, port), None)
+
+
+def describe(sock):
+    """Short description of the transport, e.g. TLSv1.3 (resumed)"""
+    if isinstance(sock, ssl.SSLSocket):
+        try:
+            resumed = ' (resumed)' if sock.session_reused else ''
+            return f"{sock.version()}{resumed}"
+        except (ValueError, OSError):
+            return 'TLS'
+    return 'TCP'
+
+
+class RecordWriter:
+    """
+    Coalesces writes to a socket into TLS_RECORD_SIZE sends so that a header
+    and its payload, or several small messages, share records instead of each
+    paying the per-record framing and MAC cost. Also serializes writers so
+    two threads never interleave bytes on the same stream.
+
+    throttle, if set, is called as throttle(nbytes, interactive) before every
+    send and may block to shape bandwidth.
+    """
+
+    def __init__(self, sock: socket.socket, record_size: int = TLS_RECORD_SIZE, throttle=None):
+        self.sock = sock
+        self.record_size = record_size
+        self.throttle = throttle
+        self.buf = bytearray()
+        self.lock = threading.Lock()
+        # control messages that arrived while another thread held the lock
+        self.deferred = deque()
+
+    def write(self, data):
+        """Buffer data, sending every full record"""
+        with self.lock:
+            self._write(data, False)
+        self._drain_deferred()
+
+    def flush(self):
+        """Send whatever is buffered"""
+        with self.lock:
+            self._flush(False)
+        self._drain_deferred()
+
+    def send(self, data):
+        """Write a small interactive message and flush it in one step"""
+        with self.lock:
+            self._write(data, True)
+            self._flush(True)
+        self._drain_deferred()
+
+    def send_iter(self, pieces):
+        """Write a sequence of buffers as one uninterrupted bulk stream and flush"""
+        with self.lock:
+            for piece in pieces:
+                self._write(piece, False)
+            self._flush(False)
+        self._drain_deferred()
+
+    def send_fds(self, data, fds):
+        """Send a small message with file descriptors attached (Unix sockets only)"""
+        with self.lock:
+            self._flush(False)
+            sent = socket.send_fds(self.sock, [data], fds)
+            if sent < len(data):
+                self.sock.sendall(data[sent:])
+        self._drain_deferred()
+
+    def send_nowait(self, data, on_sent=None):
+        """
+        Send a small message without waiting for another writer: if one holds
+        the stream (e.g. a file transfer) the message goes out right after it.
+        Receiver threads use this so they never stop reading, which could
+        otherwise deadlock two peers sending files to each other; the console
+        uses it so `send` never waits behind a transfer.
+        on_sent(error) is called once the message is on the wire (error None)
+        or failed to go out, from whichever thread sent it.
+        """
+        self.deferred.append((data, on_sent))
+        self._drain_deferred()
+
+    def _drain_deferred(self):
+        while self.deferred and self.lock.acquire(blocking=False):
+            callbacks = []
+            error = None
+            try:
+                while self.deferred:
+                    data, on_sent = self.deferred.popleft()
+                    if on_sent is not None:
+                        callbacks.append(on_sent)
+                    self._write(data, True)
+                self._flush(True)
+            except OSError as e:
+                error = e
+                raise
+            finally:
+                self.lock.release()
+                for on_sent in callbacks:
+                    on_sent(error)
+
+    def _sendall(self, data, interactive):
+        if self.throttle is not None:
+            self.throttle(len(data), interactive)
+        self.sock.sendall(data)
+
+    def _write(self, data, interactive):
+        view = memoryview(data)
+        size = self.record_size
+
+        # Top up the partial record first
+        if self.buf:
+            take = min(size - len(self.buf), len(view))
+            self.buf += view[:take]
+            view = view[take:]
+            if len(self.buf) < size:
+                return
+            self._sendall(self.buf, interactive)
+            self.buf.clear()
+
+        # Send full records straight from the caller's buffer
+        while len(view) >= size:
+            self._sendall(view[:size], interactive)
+            view = view[size:]
+
+        self.buf += view
+
+    def _flush(self, interactive):
+        if self.buf:
+            self._sendall(self.buf, interactive)
+            self.buf.clear()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+UDP side channel for chat messages. A node binds a UDP socket on its TCP
+port and advertises it in its hello; messages to peers that did the same
+go out as single datagrams, so they never wait behind a file transfer on
+the TCP stream. Files always stay on TCP.
+
+    MSG <token> <seq> <text>      answered with ACK <token> <seq>
+
+The token is the one the receiving side put in its hello, so a datagram is
+matched to its connection without trusting the source address. Each message
+is acknowledged on its own and only unacknowledged ones are retransmitted.
+After RETRIES unanswered attempts the message goes over TCP instead and
+the connection stops using UDP (e.g. a firewall drops it). Datagrams are
+not encrypted, so TLS connections never use this channel.
+"""
+
+import queue
+import secrets
+import socket
+import threading
+from collections import deque
+
+import control
+from console import console
+
+MAX_DATAGRAM = 1200  # fits any path MTU we are likely to see
+RETRIES = 3
+
+# Retransmit timeout bounds (seconds), before exponential backoff
+INITIAL_RTO = 0.2
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+
+# Sequence numbers remembered per connection to drop duplicates
+SEEN_WINDOW = 4096
+
+
+def new_token():
+    return secrets.token_hex(8)
+
+
+def retransmit_timeout(stats):
+    """RTO from a connection's RttStats (RFC 6298: srtt + 4 * rttvar)"""
+    if stats is None or stats.srtt is None:
+        return INITIAL_RTO
+    return min(MAX_RTO, max(MIN_RTO, stats.srtt + 4 * stats.rttvar))
+
+
+def usable(conn_info):
+    """True if messages on this connection go over UDP"""
+    return (conn_info.get('udp_ok', False) and conn_info.get('udp_token') is not None
+            and 'udptoken' in conn_info['peer_hello'])
+
+
+class RecentSeqs:
+    """The last SEEN_WINDOW sequence numbers received on a connection"""
+
+    def __init__(self, size=SEEN_WINDOW):
+        self.seen = set()
+        self.order = deque()
+        self.size = size
+        self.lock = threading.Lock()
+
+    def first(self, seq):
+        """True the first time seq is seen; retransmits and TCP fallbacks repeat it"""
+        with self.lock:
+            if seq in self.seen:
+                return False
+            self.seen.add(seq)
+            self.order.append(seq)
+            if len(self.order) > self.size:
+                self.seen.discard(self.order.popleft())
+            return True
+
+
+class UdpChannel:
+    def __init__(self, port, conn_manager):
+        self.port = port
+        self.conn_manager = conn_manager
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(('', port))
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.settimeout(1.0)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        
+        # Retransmits and TCP fallbacks, queued by ack timeouts. Sent from
+        # our own thread: a fallback can block on a full TCP window, which
+        # must not hold up the ack tracker's timer thread.
+        self.resends = queue.Queue()
+        self.resend_thread = threading.Thread(target=self._resend, daemon=True)
+        self.resend_thread.start()
+
+    def close(self):
+        self.closed = True
+        self.resends.put(None)
+        self.sock.close()
+
+    def send_message(self, conn_id, conn_info, text):
+        """
+        Send a chat message as a datagram. Returns False if it is too big for
+        one, in which case the caller sends it over TCP.
+        """
+        seq = self.conn_manager.acks.next_seq()
+        datagram = f"MSG {conn_info['peer_hello']['udptoken']} {seq} {text}".encode('utf-8')
+        if len(datagram) > MAX_DATAGRAM:
+            return False
+        try:
+            addr = (conn_info['ip'], int(conn_info['peer_hello']['udp']))
+        except ValueError:
+            return False
+        self._transmit(conn_id, seq, text, datagram, addr, 0)
+        return True
+
+    def _transmit(self, conn_id, seq, text, datagram, addr, attempt):
+        conn_info = self.conn_manager.get_connection(conn_id)
+        if not conn_info:
+            return
+        timeout = retransmit_timeout(conn_info['rtt']) * 2 ** attempt
+
+        def on_done(rtt, ok):
+            if rtt is not None:
+                if self.conn_manager.acks.receipts:
+                    console.emit(f'Message {seq} confirmed by connection {conn_id} ({rtt * 1000:.1f} ms)')
+            elif attempt < RETRIES:
+                self.resends.put((self._transmit, (conn_id, seq, text, datagram, addr, attempt + 1)))
+            else:
+                self.resends.put((self._fall_back, (conn_id, seq, text)))
+
+        # Karn's rule: the RTT of a retransmitted message is ambiguous
+        self.conn_manager.acks.register(conn_id, 'm' + seq, f'Message {seq}', timeout,
+                                        on_done, rtt_sample=attempt == 0)
+        try:
+            self.sock.sendto(datagram, addr)
+        except OSError:
+            pass  # handled like a lost datagram
+
+    def _fall_back(self, conn_id, seq, text):
+        """Resend over TCP (same seq, so the peer drops a late duplicate)"""
+        if not self.conn_manager.get_connection(conn_id):
+            return
+        if self.conn_manager.set_udp_ok(conn_id, False):
+            console.error(f'UDP to connection {conn_id} is not getting through, using TCP for messages')
+        self.conn_manager.acks.register(conn_id, 'm' + seq, f'Message {seq}', control.MESSAGE_ACK_TIMEOUT)
+        # a failed send means the connection is going away, which drops the ack
+        self.conn_manager.send_control(conn_id, f'__MSG__ {seq} {text}\n')
+
+    def _resend(self):
+        while True:
+            item = self.resends.get()
+            if item is None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except OSError as e:
+                console.error(f'UDP resend failed: {e}')
+
+    def _run(self):
+        while not self.closed:
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                kind, token, seq, *rest = data.decode('utf-8').split(' ', 3)
+            except (UnicodeDecodeError, ValueError):
+                continue
+            conn_id = self.conn_manager.find_udp_token(token)
+            if conn_id is None:
+                continue  # stale or forged
+            conn_info = self.conn_manager.get_connection(conn_id)
+            if not conn_info:
+                continue
+
+            if kind == 'MSG' and rest:
+                peer_token = conn_info['peer_hello'].get('udptoken')
+                if peer_token is None:
+                    continue
+                try:
+                    self.sock.sendto(f'ACK {peer_token} {seq}'.encode('utf-8'), addr)
+                except OSError:
+                    pass
+                if conn_info['seen'].first(seq):
+                    console.message(conn_info['ip'], conn_info['port'], rest[0])
+            elif kind == 'ACK':
+                self.conn_manager.acks.resolve(conn_id, 'm' + seq)